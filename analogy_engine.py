@@ -0,0 +1,191 @@
+"""
+Numeric single-substitution analogy engine.
+
+Every pair of dataset rows that differ by exchanging one element for another at the same
+amount (PrBrO -> PrClO) is indexed once, with its property deltas stored as arrays. A query
+D is then answered by every A:B::C:D analogy at once: C is a row that turns into D under the
+substitution X -> Y, A -> B is any indexed pair with the same substitution, and
+P(D) = P(C) + P(B) - P(A). The estimate is the median over all analogies, which makes a
+millisecond baseline and a pre-screen for queries that do not need a model call.
+
+python analogy_engine.py 351_ABC_129_mp-30273.csv NdClO band_gap
+"""
+import sys
+from functools import lru_cache
+
+import numpy as np
+
+from llm_analogies import PREDICTION_COLUMNS, schema_map
+
+PRESCREEN_MIN_ANALOGIES = 3
+PRESCREEN_REL_SPREAD = 0.10  # confident when every field's MAD <= max(ABS, REL * |median|)
+PRESCREEN_ABS_SPREAD = 0.10
+
+
+def _keys(rows: np.ndarray) -> np.ndarray:
+    """
+    One hashable bytes key per row of a float matrix.
+    """
+    rows = np.ascontiguousarray(rows, dtype=np.float64)
+    return rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+
+
+class AnalogyEngine:
+    def __init__(self, dataset):
+        import dataset_cache
+
+        df, elements, amounts = dataset_cache.load_dataset(f"datasets/{dataset}")
+        self.formulas = np.asarray(df["formula_pretty"])
+        self.elements = elements
+        self.column = {el: j for j, el in enumerate(elements)}
+        self.amounts = np.asarray(amounts)
+        columns = sorted(set(PREDICTION_COLUMNS.values()) & set(df.columns))
+        self.property_index = {col: k for k, col in enumerate(columns)}
+        self.values = np.column_stack([np.asarray(df[col], dtype=float) for col in columns])
+
+        # One entry per (row, element present): the row with that element's column cleared,
+        # plus the element's amount. Rows sharing an entry key differ by one substitution.
+        rows, cols = np.nonzero(self.amounts)
+        context = self.amounts[rows].copy()
+        context[np.arange(len(rows)), cols] = 0.0
+        keys = _keys(np.column_stack([context, self.amounts[rows, cols]]))
+        unique_keys, group, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        self.group_of_key = {key.tobytes(): g for g, key in enumerate(unique_keys)}
+
+        order = np.argsort(group, kind="stable")
+        self.entry_rows, self.entry_cols = rows[order], cols[order]
+        self.group_starts = np.concatenate([[0], np.cumsum(counts)])
+
+        # All ordered pairs of entries within a group, vectorized: entry i pairs with every
+        # member of its group; keep those that substitute a different element.
+        sizes = counts[group[order]]
+        left = np.repeat(np.arange(len(order)), sizes)
+        offset = np.arange(len(left)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        right = np.repeat(self.group_starts[group[order]], sizes) + offset
+        keep = self.entry_cols[left] != self.entry_cols[right]
+        left, right = left[keep], right[keep]
+
+        substitution = self.entry_cols[left] * len(elements) + self.entry_cols[right]
+        pair_order = np.argsort(substitution, kind="stable")
+        self.pair_substitution = substitution[pair_order]
+        self.pair_src = self.entry_rows[left][pair_order]
+        self.pair_dst = self.entry_rows[right][pair_order]
+        self.pair_deltas = self.values[self.pair_dst] - self.values[self.pair_src]
+
+    def allowed_rows(self, material, exclude=None) -> np.ndarray:
+        """
+        Rows usable as support: the query material is masked, and so is every row that
+        `conditional_df` would drop for the subset `exclude`.
+        """
+        from pymatgen.core.composition import Composition
+
+        allowed = np.ones(len(self.formulas), dtype=bool)
+        query = Composition(material).get_el_amt_dict()
+        if set(query) <= self.column.keys():
+            vector = np.zeros(len(self.elements))
+            for el, amt in query.items():
+                vector[self.column[el]] = amt
+            allowed &= ~np.all(self.amounts == vector, axis=1)
+        for el, val in (exclude or {}).items():
+            if el in self.column:
+                allowed &= self.amounts[:, self.column[el]] != val
+        return allowed
+
+    def analogies(self, material, allowed) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Every A:B::C:`material` analogy among the allowed rows, as the index of its A -> B
+        pair and the row of its C.
+        """
+        from pymatgen.core.composition import Composition
+
+        query = Composition(material).get_el_amt_dict()
+        found = []
+        for y_el, amount in query.items():
+            others = {el: amt for el, amt in query.items() if el != y_el}
+            if y_el not in self.column or not others.keys() <= self.column.keys():
+                continue
+            context = np.zeros(len(self.elements) + 1)
+            for el, amt in others.items():
+                context[self.column[el]] = amt
+            context[-1] = amount
+            g = self.group_of_key.get(_keys(context[None, :])[0].tobytes())
+            if g is None:
+                continue
+            y = self.column[y_el]
+            start, stop = self.group_starts[g], self.group_starts[g + 1]
+            for c, x in zip(self.entry_rows[start:stop], self.entry_cols[start:stop]):
+                if x == y or not allowed[c]:
+                    continue
+                code = x * len(self.elements) + y
+                lo, hi = np.searchsorted(self.pair_substitution, [code, code + 1])
+                pairs = np.arange(lo, hi)
+                pairs = pairs[allowed[self.pair_src[pairs]] & allowed[self.pair_dst[pairs]]]
+                found.append((pairs, np.full(len(pairs), c)))
+        if not found:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        return np.concatenate([p for p, _ in found]), np.concatenate([c for _, c in found])
+
+    def predict(self, material, response_type, exclude=None) -> dict:
+        """
+        Median analogy estimate of every prediction field of `response_type`. Returns the
+        response object, the number of analogies, the per-field median absolute deviation and
+        whether the estimate is confident enough to stand in for a model call. Without any
+        analogy, the median of the allowed rows is returned and marked not confident.
+        """
+        schema = schema_map[response_type]
+        fields = [f for f in PREDICTION_COLUMNS if f.partition(".")[0] in schema.model_fields]
+        columns = [self.property_index[PREDICTION_COLUMNS[f]] for f in fields]
+        allowed = self.allowed_rows(material, exclude)
+        pairs, c_rows = self.analogies(material, allowed)
+
+        if len(pairs):
+            estimates = self.values[c_rows][:, columns] + self.pair_deltas[pairs][:, columns]
+            medians = np.nanmedian(estimates, axis=0)
+            spread = np.nanmedian(np.abs(estimates - medians), axis=0)
+            confident = len(pairs) >= PRESCREEN_MIN_ANALOGIES and bool(np.all(
+                spread <= np.maximum(PRESCREEN_ABS_SPREAD, PRESCREEN_REL_SPREAD * np.abs(medians))
+            ))
+            best = int(np.nanargmin(np.nansum(np.abs(estimates - medians), axis=1)))
+            pair = pairs[best]
+            a, b, c = self.formulas[self.pair_src[pair]], self.formulas[self.pair_dst[pair]], self.formulas[c_rows[best]]
+            text = (
+                f"{a} is to {b} as {c} is to {material}. Applying the shift from {a} to {b} to {c} "
+                f"gives the median estimate over {len(pairs)} single-substitution analogies."
+            )
+        else:
+            medians = np.nanmedian(self.values[allowed][:, columns], axis=0)
+            spread = np.full(len(fields), np.nan)
+            confident = False
+            text = f"No single-substitution analogy reaches {material}; this is the median of the support data."
+
+        data = {"explanation": text} if response_type == "all" else {"analogy": text, "code": None, "math": None}
+        for field, value in zip(fields, medians):
+            name, _, sub = field.partition(".")
+            if sub:
+                data.setdefault(name, {})[sub] = float(value)
+            else:
+                data[name] = float(value)
+        return {
+            "response": schema.model_validate(data),
+            "n_analogies": len(pairs),
+            "spread": dict(zip(fields, spread.tolist())),
+            "confident": confident,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_engine(dataset) -> AnalogyEngine:
+    return AnalogyEngine(dataset)
+
+
+if __name__ == "__main__":
+    import time
+
+    dataset, material, response_type = sys.argv[1:4]
+    engine = get_engine(dataset)
+    print(f"{len(engine.pair_src)} single-substitution pairs in {dataset}")
+    start = time.perf_counter()
+    estimate = engine.predict(material, response_type)
+    print(f"{(time.perf_counter() - start) * 1e3:.1f} ms")
+    print(estimate["response"].model_dump_json(indent=2))
+    print({key: value for key, value in estimate.items() if key != "response"})
@@ -0,0 +1,220 @@
+"""
+Cost- and latency-aware model cascade.
+
+A query goes to the cheapest model of the family first and moves up a tier only when the
+answer looks unreliable: samples disagree, a value is physically out of range, or no sample
+parses into the response schema. Every attempt records its latency, estimated cost and
+values, so `cascade_report` can compare the tiers on leave-one-out results.
+
+python main.py -d 351_ABC_129_mp-30273.csv -p band_gap -m cascade-gpt-5 --leave-one-out
+python cascade.py output-materials/loo/351_ABC_129_mp-30273_band_gap_cascade-gpt-5.jsonl
+"""
+import json
+import sys
+import time
+from statistics import mean
+from typing import Optional, Union
+
+from llm_analogies import (
+    AllResponse,
+    BandGapResponse,
+    FormationEnergyResponse,
+    PREDICTION_COLUMNS,
+    VolumeResponse,
+    prediction_values,
+)
+from pydantic import BaseModel, ConfigDict
+
+CASCADE_SAMPLES = 3  # samples per tier, so disagreement can be measured
+
+# USD per million (input, output) tokens
+MODEL_COSTS = {
+    "gpt-5-nano": (0.05, 0.40),
+    "gpt-5-mini": (0.25, 2.00),
+    "gpt-5": (1.25, 10.00),
+    "claude-3-7-sonnet-20250219": (3.00, 15.00),
+    "gemini-2.5-flash": (0.30, 2.50),
+}
+
+# Physically plausible (low, high) range of each flattened prediction field
+PREDICTION_BOUNDS = {
+    "band_gap_prediction": (0.0, 15.0),
+    "formation_energy_prediction": (-6.0, 4.0),
+    "volume_prediction.a": (1.0, 60.0),
+    "volume_prediction.b": (1.0, 60.0),
+    "volume_prediction.c": (1.0, 60.0),
+    "volume_prediction.volume": (5.0, 20_000.0),
+}
+
+class TierAttempt(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    model: str
+    latency: float
+    cost: Optional[float]  # USD; None if the provider did not report token usage
+    values: Optional[dict[str, float]]
+    escalation: Optional[str]  # why the cascade moved past this tier; None if accepted
+
+
+class CascadeResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    prediction: Union[AllResponse, BandGapResponse, FormationEnergyResponse, VolumeResponse]
+    model: str
+    attempts: list[TierAttempt]
+
+
+def cascade_tiers(top_model: str) -> list[str]:
+    """
+    Models of `top_model`'s family that cost no more than it, cheapest first.
+    """
+    from llm_inference import MODEL_FAMILIES, get_model_family
+
+    if top_model not in MODEL_COSTS:
+        raise ValueError(f"No cost is known for {top_model}; add it to MODEL_COSTS")
+    family = MODEL_FAMILIES[get_model_family(top_model)]
+    tiers = [m for m in family if m in MODEL_COSTS and MODEL_COSTS[m] <= MODEL_COSTS[top_model]]
+    return sorted(tiers, key = lambda m: MODEL_COSTS[m])
+
+
+def estimate_cost(model: str, usage: dict) -> Optional[float]:
+    """
+    Cost of the provider-reported token usage, whose output tokens include reasoning tokens.
+    None when the provider did not report it (e.g. a stream cancelled early).
+    """
+    if usage["input_tokens"] is None or usage["output_tokens"] is None:
+        return None
+    input_cost, output_cost = MODEL_COSTS[model]
+    return (usage["input_tokens"] * input_cost + usage["output_tokens"] * output_cost) / 1e6
+
+
+def out_of_range(values: dict[str, float]) -> list[str]:
+    return [
+        key for key, value in values.items()
+        if key in PREDICTION_BOUNDS and not PREDICTION_BOUNDS[key][0] <= value <= PREDICTION_BOUNDS[key][1]
+    ]
+
+
+def cascade_inference(df, material, response_type, top_model, samples=1, tolerance=None, **inference_options):
+    """
+    Run the cascade up to `top_model` and return a CascadeResponse. The last tier's answer
+    is accepted whatever its confidence, provided at least one of its samples parsed.
+    """
+    from sampling import REL_TOLERANCE, self_consistent_inference
+
+    tiers = cascade_tiers(top_model)
+    attempts = []
+    accepted = None
+    for i, model in enumerate(tiers):
+        last = i == len(tiers) - 1
+        start = time.perf_counter()
+        try:
+            sampled = self_consistent_inference(
+                df,
+                material,
+                response_type,
+                model,
+                max_samples = max(samples, CASCADE_SAMPLES),
+                rel_tolerance = REL_TOLERANCE if tolerance is None else tolerance,
+                **inference_options,
+            )
+        except ValueError as e:
+            # No sample parsed into the schema; network, auth and rate-limit errors propagate.
+            print(f"[cascade] {model}: {e}")
+            attempts.append(TierAttempt(
+                model = model,
+                latency = time.perf_counter() - start,
+                cost = 0.0,
+                values = None,
+                escalation = "schema failure",
+            ))
+            continue
+        latency = time.perf_counter() - start
+
+        values = prediction_values(sampled.prediction)
+        escalation = None
+        bad = out_of_range(values)
+        if bad:
+            escalation = f"out of range: {', '.join(bad)}"
+        elif not sampled.converged:
+            escalation = "sample disagreement"
+        if last:
+            escalation = None
+        attempts.append(TierAttempt(
+            model = model,
+            latency = latency,
+            cost = estimate_cost(model, sampled.usage),
+            values = values,
+            escalation = escalation,
+        ))
+        if escalation is None:
+            accepted = (model, sampled.prediction)
+            break
+        print(f"[cascade] {material}: escalating past {model} ({escalation})")
+
+    if accepted is None:
+        raise RuntimeError(f"No tier of the {top_model} cascade returned a valid prediction for {material}")
+    model, prediction = accepted
+    print(
+        f"[cascade] {material}: answered by {model} after {len(attempts)} tier(s), "
+        f"{sum(a.latency for a in attempts):.1f}s, ${sum(a.cost or 0.0 for a in attempts):.5f}"
+    )
+    return CascadeResponse(prediction = prediction, model = model, attempts = attempts)
+
+
+def cascade_report(path: str) -> dict:
+    """
+    Per-tier summary of a leave-one-out result file produced with a cascade model: how often
+    each tier was queried and accepted, its mean latency, total cost, and the mean absolute
+    error of its values (over every query it answered, and over the ones it was accepted for).
+    """
+    with open(path, encoding = "utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    # Subsets that share a support table share one response; count each response once.
+    seen = set()
+    tiers = {}
+    for record in records:
+        key = (record["material"], json.dumps(record["prediction"], sort_keys=True))
+        if key in seen:
+            continue
+        seen.add(key)
+        for attempt in record["prediction"]["attempts"]:
+            tier = tiers.setdefault(attempt["model"], {
+                "queried": 0, "accepted": 0, "latency": [], "cost": 0.0, "errors": [], "accepted_errors": [],
+            })
+            tier["queried"] += 1
+            tier["latency"].append(attempt["latency"])
+            tier["cost"] += attempt["cost"] or 0.0
+            if attempt["values"] is None:
+                continue
+            errors = [
+                abs(value - record["truth"][PREDICTION_COLUMNS[name]])
+                for name, value in attempt["values"].items()
+                if PREDICTION_COLUMNS.get(name) in record["truth"]
+            ]
+            tier["errors"].extend(errors)
+            if attempt["escalation"] is None:
+                tier["accepted"] += 1
+                tier["accepted_errors"].extend(errors)
+
+    report = {}
+    for model, tier in tiers.items():
+        report[model] = {
+            "queried": tier["queried"],
+            "accepted": tier["accepted"],
+            "mean_latency": mean(tier["latency"]),
+            "cost": tier["cost"],
+            "mae": mean(tier["errors"]) if tier["errors"] else None,
+            "accepted_mae": mean(tier["accepted_errors"]) if tier["accepted_errors"] else None,
+        }
+    print(f"{'tier':<28} {'queried':>7} {'accepted':>8} {'latency':>8} {'cost $':>9} {'MAE':>8} {'acc. MAE':>8}")
+    fmt = lambda x: "n/a" if x is None else f"{x:.3f}"
+    for model, row in sorted(report.items(), key = lambda item: MODEL_COSTS.get(item[0], (0, 0))):
+        print(
+            f"{model:<28} {row['queried']:>7} {row['accepted']:>8} {row['mean_latency']:>7.1f}s "
+            f"{row['cost']:>9.4f} {fmt(row['mae']):>8} {fmt(row['accepted_mae']):>8}"
+        )
+    return report
+
+
+if __name__ == "__main__":
+    cascade_report(sys.argv[1])
@@ -0,0 +1,121 @@
+"""
+Binary columnar cache for the CSV datasets.
+
+The first load of a CSV writes each column as a .npy file under datasets/.cache/<name>-<sha>/,
+plus an element-amount matrix when the CSV has a `formula_pretty` column. Later loads
+memory-map those files instead of parsing the CSV and every formula again. The directory is
+named by the SHA-256 of the source CSV, so an edited CSV gets a new cache next to the old one;
+a cache directory is never deleted while another process may be reading it.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = "datasets/.cache"
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _cache_path(csv_path: str, source_hash: str) -> str:
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(CACHE_DIR, f"{name}-{source_hash[:16]}")
+
+
+def element_amounts(formulas) -> tuple[list, np.ndarray]:
+    """
+    Element symbols and an (n_formulas, n_elements) matrix of their amounts in each formula.
+    """
+    from pymatgen.core.composition import Composition
+
+    comps = [Composition(f).get_el_amt_dict() for f in formulas]
+    elements = sorted({el for comp in comps for el in comp})
+    column = {el: j for j, el in enumerate(elements)}
+    amounts = np.zeros((len(comps), len(elements)))
+    for i, comp in enumerate(comps):
+        for el, amt in comp.items():
+            amounts[i, column[el]] = amt
+    return elements, amounts
+
+
+def build_cache(csv_path: str, source_hash: str | None = None) -> str:
+    source_hash = source_hash or _file_hash(csv_path)
+    df = pd.read_csv(csv_path)
+    path = _cache_path(csv_path, source_hash)
+    tmp = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+
+    columns = []
+    for i, name in enumerate(df.columns):
+        col = df[name]
+        nulls = col.isna().to_numpy()
+        if pd.api.types.is_numeric_dtype(col) or pd.api.types.is_bool_dtype(col):
+            values = col.to_numpy()
+        else:
+            # Fixed-width unicode, so string columns memory-map like numeric ones.
+            values = col.fillna("").astype(str).to_numpy(dtype=str)
+        np.save(os.path.join(tmp, f"{i}.npy"), values)
+        has_nulls = bool(nulls.any()) and values.dtype.kind == "U"
+        if has_nulls:
+            np.save(os.path.join(tmp, f"{i}.nulls.npy"), nulls)
+        columns.append({"name": name, "nulls": has_nulls})
+
+    elements = None
+    if "formula_pretty" in df.columns:
+        elements, amounts = element_amounts(df["formula_pretty"])
+        np.save(os.path.join(tmp, "amounts.npy"), amounts)
+
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "source_hash": source_hash,
+            "columns": columns,
+            "elements": elements,
+        }, f)
+
+    # Rename the finished cache into place in one step so readers never see a partial one.
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Another process finished first; its cache is for the same source, so keep it.
+        shutil.rmtree(tmp, ignore_errors=True)
+    return path
+
+
+def load_dataset(csv_path: str) -> tuple[pd.DataFrame, list | None, np.ndarray | None]:
+    """
+    Return the dataset frame, its element symbols and element-amount matrix (None for CSVs
+    without `formula_pretty`), building or refreshing the cache as needed.
+    Numeric columns share memory with their read-only memory maps, as does the matrix;
+    string columns are converted to pandas strings.
+    """
+    source_hash = _file_hash(csv_path)
+    path = _cache_path(csv_path, source_hash)
+    if not os.path.exists(path):
+        path = build_cache(csv_path, source_hash)
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+
+    columns = []
+    for i, column in enumerate(meta["columns"]):
+        values = np.load(os.path.join(path, f"{i}.npy"), mmap_mode="r")
+        if column["nulls"]:
+            nulls = np.load(os.path.join(path, f"{i}.nulls.npy"))
+            values = np.where(nulls, None, values)
+        columns.append(pd.Series(values, name=column["name"], copy=False))
+    # Concatenating separate Series keeps one block per column; a dict of arrays would be
+    # consolidated into a copied block.
+    df = pd.concat(columns, axis=1)
+
+    elements, amounts = meta["elements"], None
+    if elements is not None:
+        amounts = np.load(os.path.join(path, "amounts.npy"), mmap_mode="r")
+    return df, elements, amounts
@@ -1,5 +1,6 @@
-import pandas as pd
 import itertools as it
+import numpy as np
+from dataset_cache import load_dataset
 from pymatgen.core.composition import Composition
 
 
@@ -13,22 +14,17 @@ def dict_power_set(dictionary):
 
 
 def evaluate_element_duplication():
-    analogs = pd.read_csv("datasets/" + input(str("datasets/")))
+    _, elements, amounts = load_dataset("datasets/" + input(str("datasets/")))
     reference_formula = input(str("Reference formula: "))
-    formula_list = analogs["formula_pretty"].tolist()
     reference_composition = Composition(reference_formula).get_el_amt_dict()
     reference_power_set = dict_power_set(reference_composition)
 
     for element_dict in reference_power_set:
-        count = 0
-        for formula in formula_list:
-            composition = Composition(formula).get_el_amt_dict()
-            for element in element_dict.keys():
-                if element in composition.keys():
-                    if element_dict[element] == composition[element]:
-                        count +=1
-                        break
-        print(element_dict, count)
+        shared = np.zeros(len(amounts), dtype=bool)
+        for element, amount in element_dict.items():
+            if element in elements:
+                shared |= amounts[:, elements.index(element)] == amount
+        print(element_dict, int(shared.sum()))
 
 
 if __name__ == "__main__":
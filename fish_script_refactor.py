@@ -1,12 +1,8 @@
-from api_key import (
-    ANTHROPIC_API_KEY,
-    GOOGLE_GENAI_API_KEY,
-    HUGGINGFACE_API_KEY,
-    OPENAI_API_KEY,
-)
-from openai import OpenAI
+from dataset_cache import load_dataset
+from functools import lru_cache
 from prompts.scents import SYSTEM_SCENT, USER_SCENT
 from pydantic import BaseModel, Field, ConfigDict
+from rate_limit import governed
 from typing import Annotated
 from string import Template
 import json
@@ -14,7 +10,6 @@ import pandas as pd
 from tqdm import tqdm
 
 
-client = OpenAI(api_key = OPENAI_API_KEY)
 HundredScale = Annotated[float, Field(ge=0.0, le=100.0)]
 
 
@@ -60,14 +55,28 @@ class ScentResponseSeven(BaseModel):
     familiar: Annotated[HundredScale, Field(description="Predicted rating for 'familiar' aspect.")]
 
 
+@lru_cache(maxsize=None)
+def read_molecules(csv_file):
+    """Read a molecule CSV once per process; the cached frame must not be modified in place"""
+    df, _, _ = load_dataset(csv_file)
+    return df
+
+
 def load_analogues_data(csv_file, target_molecule):
     """Load CSV and format for prompts, hiding target molecule"""
-    df = pd.read_csv(csv_file)
+    df = read_molecules(csv_file)
     df_filtered = df[df['OdorName'] != target_molecule]
     print(f"Target '{target_molecule}' hidden. Using {len(df_filtered)} analogues out of {len(df)} total molecules.")
     return df_filtered.to_csv()
 
 
+@lru_cache(maxsize=None)
+def openai_client():
+    from api_key import OPENAI_API_KEY
+    from openai import OpenAI
+    return OpenAI(api_key = OPENAI_API_KEY)
+
+
 def call_openai(user_prompt):
     response_format = {
         "type": "json_schema",
@@ -79,14 +88,15 @@ def call_openai(user_prompt):
         }
     }
     try:
-        response = client.chat.completions.create(
-            model="gpt-5-mini",
-            response_format=response_format,
-            messages=[
-                {"role": "system", "content": SYSTEM_SCENT},
-                {"role": "user", "content": user_prompt},
-            ],
-        )
+        with governed("openai", "gpt-5-mini", SYSTEM_SCENT, user_prompt):
+            response = openai_client().chat.completions.create(
+                model="gpt-5-mini",
+                response_format=response_format,
+                messages=[
+                    {"role": "system", "content": SYSTEM_SCENT},
+                    {"role": "user", "content": user_prompt},
+                ],
+            )
         # return response.choices[0].message.content
         return json.loads(response.choices[0].message.content)
     except Exception as e:
@@ -138,7 +148,7 @@ def predict_one_molecule(csv_file, query_molecule):
 
 def run_experiment(csv_file, n_molecules=20):
     """Run the molecular analogical reasoning experiment"""
-    df = pd.read_csv(csv_file)
+    df = read_molecules(csv_file)
     df = df.head(n_molecules)
     print(f"Testing {len(df)} molecules using basic prompting")
     results = []
@@ -0,0 +1,77 @@
+"""
+Measures the import cost of the entry points with `python -X importtime` and fails
+when one goes over its time budget or eagerly imports a module that should load lazily.
+Run from the repository root: python import_budget.py
+"""
+import subprocess
+import sys
+
+HEAVY_MODULES = [
+    "api_key",
+    "langchain",
+    "mp_api",
+    "openai",
+    "pandas",
+    "pymatgen",
+    "torch",
+    "transformers",
+]
+
+# module: (cumulative import seconds, modules it must not import)
+IMPORT_BUDGETS = {
+    "main": (0.10, HEAVY_MODULES),
+    "llm_inference": (0.10, HEAVY_MODULES),
+    "llm_analogies": (0.50, HEAVY_MODULES),
+    "llm_local": (0.10, HEAVY_MODULES),
+    "mp_structural_analogs": (0.10, HEAVY_MODULES),
+    "server": (0.20, HEAVY_MODULES),
+    "fish_script_refactor": (2.00, ["api_key", "langchain", "openai", "pymatgen", "torch"]),
+}
+
+
+def measure_import(module: str) -> tuple[float, set]:
+    """
+    Return the cumulative import time of `module` in seconds and every module it imported.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+    cumulative = 0.0
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        name = name.strip()
+        if not cumulative_us.strip().isdigit():
+            continue
+        imported.add(name)
+        if name == module:
+            cumulative = int(cumulative_us) / 1e6
+    return cumulative, imported
+
+
+def check_budgets() -> bool:
+    ok = True
+    for module, (budget, forbidden) in IMPORT_BUDGETS.items():
+        seconds, imported = measure_import(module)
+        eager = sorted(
+            name for name in imported
+            if any(name == f or name.startswith(f + ".") for f in forbidden)
+        )
+        status = "ok"
+        if seconds > budget or eager:
+            ok = False
+            status = "OVER BUDGET" if seconds > budget else "EAGER IMPORTS"
+        print(f"{module:<24} {seconds:6.3f}s / {budget:.2f}s  {status}")
+        if eager:
+            print(f"    imports {', '.join(eager[:5])}{' ...' if len(eager) > 5 else ''}")
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_budgets() else 1)
@@ -0,0 +1,187 @@
+"""
+Character-level grammar of the JSON documents a pydantic JSON schema accepts.
+
+Used by the local backend to constrain decoding: a parse state is a tuple of frames, and
+`advance` returns the state after some text, or None once the text can no longer be the
+prefix of a valid document. Objects are generated with every property, in schema order,
+which any `extra="forbid"` response model accepts. Supports objects, arrays, strings,
+numbers, integers, booleans, null, `anyOf` and `$ref`.
+"""
+import json
+
+WHITESPACE = " \t\n\r"
+MAX_WHITESPACE = 16  # characters per run, so a weak model cannot spend its tokens on indentation
+ESCAPES = '"\\/bfnrt'
+HEX_DIGITS = "0123456789abcdefABCDEF"
+
+# Number phase -> {character class: next phase}; a number may end in the phases of NUMBER_END.
+NUMBER_PHASES = {
+    "sign": {"0": "zero", "digit": "int"},
+    "zero": {".": "point", "e": "exp"},
+    "int": {"0": "int", "digit": "int", ".": "point", "e": "exp"},
+    "point": {"0": "frac", "digit": "frac"},
+    "frac": {"0": "frac", "digit": "frac", "e": "exp"},
+    "exp": {"sign": "exp_sign", "0": "exp_digits", "digit": "exp_digits"},
+    "exp_sign": {"0": "exp_digits", "digit": "exp_digits"},
+    "exp_digits": {"0": "exp_digits", "digit": "exp_digits"},
+}
+NUMBER_END = {"zero", "int", "frac", "exp_digits"}
+
+
+def _number_class(ch: str) -> str:
+    if ch == "0":
+        return "0"
+    if "1" <= ch <= "9":
+        return "digit"
+    if ch in "eE":
+        return "e"
+    if ch in "+-":
+        return "sign"
+    return ch
+
+
+class JSONSchemaGrammar:
+    def __init__(self, schema: dict):
+        self.defs = schema.get("$defs", {})
+        self.root = schema
+        self._check(schema, set())
+
+    def _resolve(self, node: dict) -> dict:
+        while "$ref" in node:
+            node = self.defs[node["$ref"].rsplit("/", 1)[-1]]
+        return node
+
+    def _check(self, node, seen):
+        """
+        Raise ValueError for schema constructs the grammar cannot generate.
+        """
+        node = self._resolve(node)
+        if id(node) in seen:
+            return
+        seen.add(id(node))
+        for option in node.get("anyOf", [node] if "type" in node else []):
+            option = self._resolve(option)
+            kind = option.get("type")
+            if kind == "object":
+                if "properties" not in option:
+                    raise ValueError("Objects without declared properties are not supported")
+                for prop in option["properties"].values():
+                    self._check(prop, seen)
+            elif kind == "array":
+                self._check(option["items"], seen)
+            elif kind not in ("string", "number", "integer", "boolean", "null"):
+                raise ValueError(f"Unsupported schema type {kind!r}")
+        if "anyOf" not in node and "type" not in node:
+            raise ValueError(f"Unsupported schema node {sorted(node)}")
+
+    def start(self) -> tuple:
+        return (("value", self.root),)
+
+    def complete(self, state: tuple) -> bool:
+        return all(frame[0] == "ws" for frame in state)
+
+    def advance(self, state: tuple, text: str):
+        for ch in text:
+            state = self._step(state, ch)
+            if state is None:
+                return None
+        return state
+
+    def _object(self, node: dict) -> list:
+        """
+        Frames after an object's `{`, top of the stack last.
+        """
+        frames = [("ws", 0)]
+        for i, (name, prop) in enumerate(node["properties"].items()):
+            if i:
+                frames += [("lit", ","), ("ws", 0)]
+            frames += [("lit", json.dumps(name)), ("ws", 0), ("lit", ":"), ("ws", 0), ("value", prop), ("ws", 0)]
+        frames.append(("lit", "}"))
+        return frames[::-1]
+
+    def _start_value(self, stack: list, node: dict, ch: str):
+        node = self._resolve(node)
+        for option in node.get("anyOf", [node]):
+            option = self._resolve(option)
+            kind = option.get("type")
+            if kind == "object" and ch == "{":
+                stack.extend(self._object(option))
+            elif kind == "array" and ch == "[":
+                stack.append(("array", option["items"], True, 0))
+            elif kind == "string" and ch == '"':
+                stack.append(("string", 0))
+            elif kind in ("number", "integer") and (ch == "-" or ch.isdigit()):
+                phase = "sign" if ch == "-" else "zero" if ch == "0" else "int"
+                stack.append(("number", phase, kind == "integer"))
+            elif kind == "boolean" and ch in "tf":
+                stack.append(("lit", "rue" if ch == "t" else "alse"))
+            elif kind == "null" and ch == "n":
+                stack.append(("lit", "ull"))
+            else:
+                continue
+            return tuple(stack)
+        return None
+
+    def _step(self, state: tuple, ch: str):
+        stack = list(state)
+        while stack:
+            frame = stack.pop()
+            kind = frame[0]
+            if kind == "ws":
+                if ch in WHITESPACE and frame[1] < MAX_WHITESPACE:
+                    stack.append(("ws", frame[1] + 1))
+                    return tuple(stack)
+                continue  # the whitespace ended; `ch` belongs to the next frame
+            if kind == "lit":
+                if ch != frame[1][0]:
+                    return None
+                if len(frame[1]) > 1:
+                    stack.append(("lit", frame[1][1:]))
+                return tuple(stack)
+            if kind == "value":
+                return self._start_value(stack, frame[1], ch)
+            if kind == "string":
+                escape = frame[1]
+                if escape == 0:
+                    if ch == '"':
+                        return tuple(stack)
+                    if ch < " ":
+                        return None
+                    stack.append(("string", -1 if ch == "\\" else 0))
+                elif escape == -1:
+                    if ch == "u":
+                        stack.append(("string", 4))
+                    elif ch in ESCAPES:
+                        stack.append(("string", 0))
+                    else:
+                        return None
+                else:
+                    if ch not in HEX_DIGITS:
+                        return None
+                    stack.append(("string", escape - 1))
+                return tuple(stack)
+            if kind == "number":
+                _, phase, integer = frame
+                nxt = NUMBER_PHASES[phase].get(_number_class(ch))
+                if nxt is not None and not (integer and nxt in ("point", "exp")):
+                    stack.append(("number", nxt, integer))
+                    return tuple(stack)
+                if phase in NUMBER_END:
+                    continue  # the number ended; `ch` belongs to the next frame
+                return None
+            if kind == "array":
+                _, items, first, spaces = frame
+                if ch in WHITESPACE and spaces < MAX_WHITESPACE:
+                    stack.append(("array", items, first, spaces + 1))
+                    return tuple(stack)
+                if ch == "]":
+                    return tuple(stack)
+                stack.append(("array", items, False, 0))
+                if first:
+                    stack.append(("value", items))
+                    continue
+                if ch != ",":
+                    return None
+                stack += [("value", items), ("ws", 0)]
+                return tuple(stack)
+        return None  # the document is complete; nothing may follow
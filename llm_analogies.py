@@ -1,18 +1,17 @@
-from api_key import (
-    ANTHROPIC_API_KEY,
-    GOOGLE_GENAI_API_KEY,
-    HUGGINGFACE_API_KEY,
-    OPENAI_API_KEY,
-)
-from langchain.chat_models import init_chat_model
-from langchain.schema import SystemMessage, HumanMessage
+from functools import lru_cache
+from llm_local import generate_structured
+from llm_streaming import langchain_chunks, stream_structured
 from prompts.materials import SYSTEM_MATERIAL
 from pydantic import BaseModel, ConfigDict, Field
+from rate_limit import governed
 from typing import Annotated, Literal, Optional, Union
 
 Analogy = Annotated[str, Field(description="The analogy used to arrive at the prediction, including all reasoning steps.")]
 Code = Annotated[Optional[str], Field(description="Any Python code used to generate the prediction.")]
 Math = Annotated[Optional[str], Field(description="Any LaTeX equations used to generate the prediction.")]
+Explanation = Annotated[str, Field(description="Justification for the given predictions.")]
+BandGapPrediction = Annotated[float, Field(description="The predicted band gap value; number only, no units.")]
+FormationEnergyPrediction = Annotated[float, Field(description="The predicted formation energy (per atom); number only, no units.")]
 
 
 class VolumeDict(BaseModel):
@@ -22,34 +21,36 @@ class VolumeDict(BaseModel):
     c: float
     volume: float
 
+VolumePrediction = Annotated[VolumeDict, Field(description="a, b, c, volume; numbers only, no units.")]
+
 class AllResponse(BaseModel):
     model_config = ConfigDict(extra="forbid")
-    explanation: Annotated[str, Field(description="Justification for the given predictions.")]
+    explanation: Explanation
     # analogy: Analogy
-    band_gap_prediction: Annotated[float, Field(description="The predicted band gap value; number only, no units.")]
-    formation_energy_prediction: Annotated[float, Field(description="The predicted formation energy (per atom); number only, no units.")]
-    volume_prediction: Annotated[VolumeDict, Field(description="a, b, c, volume; numbers only, no units.")]
+    band_gap_prediction: BandGapPrediction
+    formation_energy_prediction: FormationEnergyPrediction
+    volume_prediction: VolumePrediction
 
 class BandGapResponse(BaseModel):
     model_config = ConfigDict(extra="forbid")
     analogy: Analogy
     code: Code = None
     math: Math = None
-    band_gap_prediction: Annotated[float, Field(description="The predicted band gap value; number only, no units.")]
+    band_gap_prediction: BandGapPrediction
 
 class FormationEnergyResponse(BaseModel):
     model_config = ConfigDict(extra="forbid")
     analogy: Analogy
     code: Code = None
     math: Math = None
-    formation_energy_prediction: Annotated[float, Field(description="The predicted formation energy (per atom); number only, no units.")]
+    formation_energy_prediction: FormationEnergyPrediction
 
 class VolumeResponse(BaseModel):
     model_config = ConfigDict(extra="forbid")
     analogy: Analogy
     code: Code = None
     math: Math = None
-    volume_prediction: Annotated[VolumeDict, Field(description="a, b, c, volume; numbers only, no units.")]
+    volume_prediction: VolumePrediction
 
 schema_map = {
     "all": AllResponse,
@@ -58,6 +59,139 @@ schema_map = {
     "volume": VolumeResponse,
 }
 
+# Streaming variants: the same fields with the predictions declared first, so a stream
+# completes them before the text and `cancel_early` can skip generating the text.
+# Validate the result into `schema_map` again with `from_stream`.
+
+class AllStreamResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    band_gap_prediction: BandGapPrediction
+    formation_energy_prediction: FormationEnergyPrediction
+    volume_prediction: VolumePrediction
+    explanation: Explanation
+
+class BandGapStreamResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    band_gap_prediction: BandGapPrediction
+    analogy: Analogy
+    code: Code = None
+    math: Math = None
+
+class FormationEnergyStreamResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    formation_energy_prediction: FormationEnergyPrediction
+    analogy: Analogy
+    code: Code = None
+    math: Math = None
+
+class VolumeStreamResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    volume_prediction: VolumePrediction
+    analogy: Analogy
+    code: Code = None
+    math: Math = None
+
+stream_schema_map = {
+    "all": AllStreamResponse,
+    "band_gap": BandGapStreamResponse,
+    "formation_energy": FormationEnergyStreamResponse,
+    "volume": VolumeStreamResponse,
+}
+
+def from_stream(response: BaseModel, response_type: str) -> BaseModel:
+    return schema_map[response_type].model_validate(response.model_dump())
+
+Material = Annotated[str, Field(description="The query material (formula) this prediction is for.")]
+Predictions = Field(description="One prediction per query material, in the order the materials were given.")
+
+class AllTarget(AllResponse):
+    material: Material
+
+class BandGapTarget(BandGapResponse):
+    material: Material
+
+class FormationEnergyTarget(FormationEnergyResponse):
+    material: Material
+
+class VolumeTarget(VolumeResponse):
+    material: Material
+
+class PackedAllResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    predictions: Annotated[list[AllTarget], Predictions]
+
+class PackedBandGapResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    predictions: Annotated[list[BandGapTarget], Predictions]
+
+class PackedFormationEnergyResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    predictions: Annotated[list[FormationEnergyTarget], Predictions]
+
+class PackedVolumeResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    predictions: Annotated[list[VolumeTarget], Predictions]
+
+packed_schema_map = {
+    "all": PackedAllResponse,
+    "band_gap": PackedBandGapResponse,
+    "formation_energy": PackedFormationEnergyResponse,
+    "volume": PackedVolumeResponse,
+}
+
+def unpack_predictions(packed: BaseModel, materials: list[str], response_type: str) -> list:
+    """
+    Split a packed response into one single-target response per query material (None if missing).
+    Targets are matched by formula, falling back to position when the model renamed them.
+    """
+    schema = schema_map[response_type]
+    targets = {t.material.strip(): t for t in packed.predictions}
+    by_position = len(packed.predictions) == len(materials)
+    responses = []
+    for i, material in enumerate(materials):
+        target = targets.get(material)
+        if target is None and by_position:
+            target = packed.predictions[i]
+        responses.append(None if target is None else schema.model_validate(target.model_dump(exclude={"material"})))
+    return responses
+
+# Flattened prediction field -> dataset column holding its ground truth
+PREDICTION_COLUMNS = {
+    "band_gap_prediction": "band_gap",
+    "formation_energy_prediction": "formation_energy_per_atom",
+    "volume_prediction.a": "a_A",
+    "volume_prediction.b": "b_A",
+    "volume_prediction.c": "c_A",
+    "volume_prediction.volume": "volume_A3",
+}
+
+def prediction_values(response: BaseModel) -> dict[str, float]:
+    """
+    Flatten the numeric prediction fields of a response, e.g. {"volume_prediction.a": 4.1, ...}.
+    """
+    values = {}
+    for name, value in response:
+        if not name.endswith("_prediction"):
+            continue
+        if isinstance(value, BaseModel):
+            values.update({f"{name}.{key}": float(v) for key, v in value})
+        else:
+            values[name] = float(value)
+    return values
+
+def with_prediction_values(response: BaseModel, values: dict[str, float]) -> BaseModel:
+    """
+    Copy of `response` with its prediction fields replaced by flattened `values`.
+    """
+    data = response.model_dump()
+    for key, value in values.items():
+        name, _, sub = key.partition(".")
+        if sub:
+            data[name][sub] = value
+        else:
+            data[name] = value
+    return type(response).model_validate(data)
+
 # def _system_with_hint(response_type: Choice) -> str:
 #     if response_type == "auto":
 #         return SYSTEM_MATERIAL
@@ -66,35 +200,104 @@ schema_map = {
 #         f"Set prediction_type='{response_type}' and include only fields of that variant."
 #     )
 
-def call_anthropic(prompt: str, response_type: str, model: str = "claude-3-5-sonnet-20241022"):
+@lru_cache(maxsize=None)
+def _chat_model(model: str, model_provider: str, api_key: str):
+    """
+    Build each provider client once per process; repeated calls reuse its connection pool.
+    """
+    from langchain.chat_models import init_chat_model
+    return init_chat_model(model, model_provider=model_provider, **{f"{model_provider}_api_key": api_key})
+
+def _structured(llm, schema, messages, include_usage: bool):
+    """
+    Invoke `llm` for `schema`; with `include_usage`, also return the provider's token counts.
+    """
+    if not include_usage:
+        return llm.with_structured_output(schema=schema).invoke(messages)
+    out = llm.with_structured_output(schema=schema, include_raw=True).invoke(messages)
+    if out["parsed"] is None:
+        raise out["parsing_error"] or ValueError(f"No {schema.__name__} in the response")
+    usage = out["raw"].usage_metadata or {}
+    return out["parsed"], {"input_tokens": usage.get("input_tokens"), "output_tokens": usage.get("output_tokens")}
+
+def _messages(prompt: str):
+    from langchain.schema import SystemMessage, HumanMessage
+    return [
+        SystemMessage(content=SYSTEM_MATERIAL),
+        HumanMessage(content=prompt),
+    ]
+
+def call_anthropic(prompt: str, response_type: str, model: str = "claude-3-5-sonnet-20241022", packed: bool = False, include_usage: bool = False):
     try:
-        schema = schema_map[response_type]
-        llm = init_chat_model(model, model_provider="anthropic", anthropic_api_key=ANTHROPIC_API_KEY)
-        messages = [
-            SystemMessage(content=SYSTEM_MATERIAL),
-            HumanMessage(content=prompt),
-        ]
-        out = llm.with_structured_output(schema=schema).invoke(messages)
+        from api_key import ANTHROPIC_API_KEY
+        schema = (packed_schema_map if packed else schema_map)[response_type]
+        llm = _chat_model(model, "anthropic", ANTHROPIC_API_KEY)
+        messages = _messages(prompt)
+        with governed("anthropic", model, SYSTEM_MATERIAL, prompt):
+            out = _structured(llm, schema, messages, include_usage)
         return out        
     except Exception as e:
         print(e)
         raise
 
-def call_openai(prompt: str, response_type: str, model: str = "gpt-5-mini"):
-    schema = schema_map[response_type]
-    llm = init_chat_model(model, model_provider="openai", openai_api_key=OPENAI_API_KEY)
-    messages = [
-        SystemMessage(content=SYSTEM_MATERIAL),
-        HumanMessage(content=prompt)
-    ]
+def call_openai(prompt: str, response_type: str, model: str = "gpt-5-mini", packed: bool = False, include_usage: bool = False):
+    from api_key import OPENAI_API_KEY
+    schema = (packed_schema_map if packed else schema_map)[response_type]
+    llm = _chat_model(model, "openai", OPENAI_API_KEY)
+    messages = _messages(prompt)
     try:
-        out = llm.with_structured_output(schema=schema).invoke(messages)
+        with governed("openai", model, SYSTEM_MATERIAL, prompt):
+            out = _structured(llm, schema, messages, include_usage)
         return out
     except Exception as e:
         print(e)
         raise
         # return call_openai(prompt = prompt, response_type = response_type, model = model)
 
+def call_huggingface(
+    prompt: str,
+    response_type: str,
+    model: str = "Qwen/Qwen2.5-1.5B-Instruct",
+    packed: bool = False,
+    temperature: float = 0.0,
+    include_usage: bool = False,
+):
+    schema = (packed_schema_map if packed else schema_map)[response_type]
+    try:
+        return generate_structured(SYSTEM_MATERIAL, prompt, schema, model, temperature, include_usage)
+    except Exception as e:
+        print(e)
+        raise
+
+def _stream_usage(usage: dict, timings: dict) -> dict:
+    """
+    Token counts of a finished stream; a cancelled stream ends before the provider reports them.
+    """
+    if timings["cancelled"]:
+        return {"input_tokens": None, "output_tokens": None}
+    return {"input_tokens": usage.get("input_tokens"), "output_tokens": usage.get("output_tokens")}
+
+def stream_anthropic(prompt: str, response_type: str, model: str = "claude-3-5-sonnet-20241022", cancel_early: bool = False):
+    from api_key import ANTHROPIC_API_KEY
+    schema = stream_schema_map[response_type]
+    llm = _chat_model(model, "anthropic", ANTHROPIC_API_KEY).bind_tools([schema], tool_choice=schema.__name__)
+    usage = {}
+    with governed("anthropic", model, SYSTEM_MATERIAL, prompt):
+        response, timings = stream_structured(langchain_chunks(llm, _messages(prompt), usage), schema, cancel_early=cancel_early)
+    return from_stream(response, response_type), timings | _stream_usage(usage, timings)
+
+def stream_openai(prompt: str, response_type: str, model: str = "gpt-5-mini", cancel_early: bool = False):
+    from api_key import OPENAI_API_KEY
+    schema = stream_schema_map[response_type]
+    llm = _chat_model(model, "openai", OPENAI_API_KEY).bind(response_format={
+        "type": "json_schema",
+        "json_schema": {"name": schema.__name__, "schema": schema.model_json_schema()},
+    }, stream_usage=True)
+    usage = {}
+    with governed("openai", model, SYSTEM_MATERIAL, prompt):
+        response, timings = stream_structured(langchain_chunks(llm, _messages(prompt), usage), schema, cancel_early=cancel_early)
+    return from_stream(response, response_type), timings | _stream_usage(usage, timings)
+
 
 if __name__ == "__main__":
     try:
@@ -1,11 +1,8 @@
-import llm_analogies
+import json
 from string import Template
-from prompts.materials import(
-    USER_BAND_GAP,
-    USER_FORMATION_ENERGY,
-    USER_VOLUME,
-    USER_ALL,
-)
+
+STREAM_TIMINGS_PATH = "output-materials/stream_timings.jsonl"
+CASCADE_PREFIX = "cascade-"  # "-m cascade-gpt-5" cascades through the family's models up to gpt-5
 
 MODEL_FAMILIES = {
     "anthropic": {
@@ -15,7 +12,8 @@ MODEL_FAMILIES = {
         "gemini-2.5-flash",
     },
     "huggingface": {
-        "Qwen/Qwen3-Next-80B-A3B-Thinking",
+        "Qwen/Qwen2.5-0.5B-Instruct",
+        "Qwen/Qwen2.5-1.5B-Instruct",
     },
     "openai": {
         "gpt-5",
@@ -32,7 +30,57 @@ def get_model_family(model_name):
     )
 
 
-def run_inference(df, material, response_type, model):
+def record_stream_timings(material, response_type, model, timings):
+    first = timings["time_to_first_prediction"]
+    print(
+        f"[stream] {material}: first prediction after "
+        f"{'n/a' if first is None else f'{first:.2f}s'} of {timings['total_time']:.2f}s"
+        f"{' (cancelled)' if timings['cancelled'] else ''}"
+    )
+    with open(STREAM_TIMINGS_PATH, "a", encoding = "utf-8") as f:
+        f.write(json.dumps({"material": material, "response_type": response_type, "model": model} | timings) + "\n")
+
+
+def run_inference(df, material, response_type, model, stream=False, cancel_early=False, samples=1, tolerance=None, temperature=0.0, include_usage=False):
+    """
+    `temperature` only applies to the local huggingface backend, which is greedy at 0;
+    the provider APIs sample at their default temperature. With `include_usage`, a single
+    sample also returns the provider's token usage ({"input_tokens", "output_tokens"}, None
+    where it was not reported).
+    """
+    if model.startswith(CASCADE_PREFIX):
+        from cascade import cascade_inference
+        return cascade_inference(
+            df,
+            material,
+            response_type,
+            model.removeprefix(CASCADE_PREFIX),
+            samples = samples,
+            tolerance = tolerance,
+            stream = stream,
+            cancel_early = cancel_early,
+        )
+    if samples > 1:
+        from sampling import REL_TOLERANCE, self_consistent_inference
+        return self_consistent_inference(
+            df,
+            material,
+            response_type,
+            model,
+            max_samples = samples,
+            rel_tolerance = REL_TOLERANCE if tolerance is None else tolerance,
+            stream = stream,
+            cancel_early = cancel_early,
+        )
+
+    import llm_analogies
+    from prompts.materials import(
+        USER_BAND_GAP,
+        USER_FORMATION_ENERGY,
+        USER_VOLUME,
+        USER_ALL,
+    )
+
     if response_type == "band_gap":
         prompt = Template(USER_BAND_GAP).substitute(
             material = material,
@@ -55,14 +103,63 @@ def run_inference(df, material, response_type, model):
         )
 
     model_family = get_model_family(model)
+    if stream:
+        if model_family == "anthropic":
+            response, timings = llm_analogies.stream_anthropic(prompt, response_type, model, cancel_early)
+        elif model_family == "openai":
+            response, timings = llm_analogies.stream_openai(prompt, response_type, model, cancel_early)
+        else:
+            raise ValueError(f"Streaming is not supported for the {model_family} model family")
+        record_stream_timings(material, response_type, model, timings)
+        if include_usage:
+            return response, {key: timings[key] for key in ("input_tokens", "output_tokens")}
+        return response
+
     if model_family == "anthropic":
-        return llm_analogies.call_anthropic(prompt, response_type, model)
+        return llm_analogies.call_anthropic(prompt, response_type, model, include_usage=include_usage)
     elif model_family == "google_genai":
         return llm_analogies.call_google_genai(prompt, response_type, model)
     elif model_family == "huggingface":
-        return llm_analogies.call_huggingface(prompt, response_type, model)
+        return llm_analogies.call_huggingface(prompt, response_type, model, temperature=temperature, include_usage=include_usage)
+    elif model_family == "openai":
+        return llm_analogies.call_openai(prompt, response_type, model, include_usage=include_usage)
+
+
+def run_packed_inference(df, materials, response_type, model):
+    """
+    Predict several query materials that share one support table in a single request.
+    Returns one response per material (None where the model left it out) and the provider's
+    token usage for the request ({"input_tokens", "output_tokens"}).
+    """
+    import llm_analogies
+    from prompts.materials import(
+        USER_BAND_GAP_PACKED,
+        USER_FORMATION_ENERGY_PACKED,
+        USER_VOLUME_PACKED,
+        USER_ALL_PACKED,
+    )
+
+    templates = {
+        "band_gap": USER_BAND_GAP_PACKED,
+        "formation_energy": USER_FORMATION_ENERGY_PACKED,
+        "volume": USER_VOLUME_PACKED,
+        "all": USER_ALL_PACKED,
+    }
+    prompt = Template(templates[response_type]).substitute(
+        materials = "\n".join(materials),
+        df = df.to_csv(index=False),
+    )
+
+    model_family = get_model_family(model)
+    if model_family == "anthropic":
+        packed, usage = llm_analogies.call_anthropic(prompt, response_type, model, packed=True, include_usage=True)
+    elif model_family == "huggingface":
+        packed, usage = llm_analogies.call_huggingface(prompt, response_type, model, packed=True, include_usage=True)
     elif model_family == "openai":
-        return llm_analogies.call_openai(prompt, response_type, model)
+        packed, usage = llm_analogies.call_openai(prompt, response_type, model, packed=True, include_usage=True)
+    else:
+        raise ValueError(f"Packed requests are not supported for the {model_family} model family")
+    return llm_analogies.unpack_predictions(packed, materials, response_type), usage
 
 
 if __name__ == "__main__":
@@ -0,0 +1,307 @@
+"""
+Local CPU inference for the huggingface model family.
+
+Concurrent callers of `generate_structured` are gathered into batches by one worker
+thread per model. Decoding is constrained to the JSON grammar of the response schema, so
+every row produces a document of the schema's shape, which pydantic then validates.
+Key/value caches of recent prompts are kept and reused by token prefix: a request reuses
+the longest prefix it shares with a cached prompt (system prompt, schema, question and
+the leading rows of the `Analogues:` table, across the subsets of one material), and a
+batch computes the prefix its rows share once and repeats it over the rows, padding each
+row between that prefix and its own suffix.
+"""
+import copy
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from string import Template
+
+from json_grammar import JSONSchemaGrammar
+
+HF_MAX_BATCH        = 8
+HF_BATCH_WAIT       = 0.05  # seconds to wait for more requests before generating
+HF_MAX_NEW_TOKENS   = 1024
+HF_PREFIX_CACHE     = 4     # prompt key/value caches kept per model
+HF_CONSTRAINT_TOP_K = 32    # candidate tokens checked against the grammar per step
+HF_DECODE_TAIL      = 8     # generated tokens decoded as context for the next token's text
+
+# Qwen3-Next mixes linear-attention layers, whose state cannot be cut back to a shared prefix,
+# and its thinking variant writes reasoning before the JSON object; 80B is also out of CPU reach.
+UNSUPPORTED_MODELS = {"Qwen/Qwen3-Next-80B-A3B-Thinking"}
+
+JSON_INSTRUCTION = """
+Respond only with a JSON object matching this JSON schema, with no other text:
+$schema
+"""
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _common_length(a, b) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class SchemaConstraint:
+    """
+    Logits processor that masks every token which would take a row out of its schema's JSON
+    grammar. The best-scoring HF_CONSTRAINT_TOP_K tokens are checked, and further ones only
+    until one fits; end-of-sequence is the only token allowed once the object is complete.
+    """
+    def __init__(self, engine, grammars):
+        self.engine = engine
+        self.grammars = grammars
+        # The prompt ends with the opening brace; see LocalEngine._render.
+        self.states = [grammar.advance(grammar.start(), "{") for grammar in grammars]
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+        for row, grammar in enumerate(self.grammars):
+            generated = input_ids[row, self.prompt_length:].tolist()
+            state = self.states[row]
+            if generated and state is not None:
+                if generated[-1] in self.engine.eos_ids:
+                    state = None  # finished; the row is only padded from here on
+                else:
+                    tail = generated[-HF_DECODE_TAIL - 1:-1]
+                    state = grammar.advance(state, self.engine.piece(tail, generated[-1]))
+                self.states[row] = state
+            if state is None:
+                continue
+            if grammar.complete(state):
+                allowed = sorted(self.engine.eos_ids)
+            else:
+                allowed = self._allowed(grammar, state, generated[-HF_DECODE_TAIL:], scores[row])
+            if not allowed:
+                continue
+            kept = scores[row, allowed]
+            scores[row] = float("-inf")
+            # Other processors may already have ruled out every token the grammar allows.
+            scores[row, allowed] = kept if self.engine.torch.isfinite(kept).any() else 0.0
+        return scores
+
+    def _allowed(self, grammar, state, tail, scores) -> list:
+        torch = self.engine.torch
+        before = self.engine.decode(tail)
+
+        def fits(token):
+            if token in self.engine.special_ids:
+                return False
+            return grammar.advance(state, self.engine.piece(tail, token, before)) is not None
+
+        allowed = [token for token in torch.topk(scores, HF_CONSTRAINT_TOP_K).indices.tolist() if fits(token)]
+        if allowed:
+            return allowed
+        for token in torch.argsort(scores, descending=True)[HF_CONSTRAINT_TOP_K:].tolist():
+            if fits(token):
+                return [token]
+        return []
+
+
+class LocalEngine:
+    def __init__(self, model: str):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache, LogitsProcessorList
+
+        self.torch = torch
+        self.DynamicCache = DynamicCache
+        self.LogitsProcessorList = LogitsProcessorList
+        self.tokenizer = AutoTokenizer.from_pretrained(model)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(model, torch_dtype=torch.float32)
+        self.model.eval()
+        eos = self.model.generation_config.eos_token_id
+        self.eos_ids = {i for i in (eos if isinstance(eos, list) else [eos]) + [self.tokenizer.eos_token_id] if i is not None}
+        self.special_ids = set(self.tokenizer.all_special_ids) | self.eos_ids
+        self.requests = queue.Queue()
+        self.prefix_cache = OrderedDict()  # prompt token ids -> key/value cache, most recent last
+        self.grammars = {}
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, system: str, prompt: str, schema: dict, temperature: float = 0.0) -> Future:
+        future = Future()
+        self.requests.put((system, prompt, schema, temperature, future))
+        return future
+
+    def _render(self, system, prompt):
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt},
+        ]
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        # Prefill the opening brace so the model starts the JSON object immediately.
+        return text + "{"
+
+    def decode(self, ids) -> str:
+        return self.tokenizer.decode(ids)
+
+    def piece(self, tail, token, before=None) -> str:
+        """
+        Text `token` adds after the generated `tail`, decoded in context so leading spaces and
+        multi-token characters come out as they will in the output.
+        """
+        if before is None:
+            before = self.decode(tail)
+        before = before.rstrip("\ufffd")
+        return self.decode(tail + [token])[len(before):]
+
+    def _grammar(self, schema: dict) -> JSONSchemaGrammar:
+        key = json.dumps(schema, sort_keys=True)
+        if key not in self.grammars:
+            self.grammars[key] = JSONSchemaGrammar(schema)
+        return self.grammars[key]
+
+    def _cached_prefix(self, ids: list):
+        """
+        Key/value cache of the token ids `ids`, extended from the cached prompt that shares the
+        longest prefix with them. The result is also cached, and a copy returned for generate().
+        """
+        best, n = None, 0
+        for key in self.prefix_cache:
+            k = _common_length(key, ids)
+            if k > n:
+                best, n = key, k
+        if best is None:
+            cache = self.DynamicCache()
+        else:
+            cache = copy.deepcopy(self.prefix_cache[best])
+            if n < len(best):
+                cache.crop(n - len(best))  # a negative count drops tokens from the end
+            self.prefix_cache.move_to_end(best)
+        if n < len(ids):
+            with self.torch.no_grad():
+                cache = self.model(
+                    self.torch.tensor([ids[n:]]),
+                    past_key_values=cache,
+                    use_cache=True,
+                ).past_key_values
+        self.prefix_cache[tuple(ids)] = cache
+        self.prefix_cache.move_to_end(tuple(ids))
+        while len(self.prefix_cache) > HF_PREFIX_CACHE:
+            self.prefix_cache.popitem(last=False)
+        return copy.deepcopy(cache)
+
+    def _sampling(self, temperature):
+        """
+        generate() arguments: greedy at temperature 0, otherwise sampled so repeated calls differ.
+        """
+        if temperature > 0:
+            return {"do_sample": True, "temperature": temperature}
+        return {"do_sample": False}
+
+    def _generate(self, batch, temperature):
+        """
+        One generate() call for the batch. Rows are laid out as the prefix they all share, then
+        padding, then each row's own suffix; the shared prefix comes from `_cached_prefix`, and
+        position ids follow the attention mask, so every row sees the positions it would alone.
+        """
+        torch = self.torch
+        rows = [self.tokenizer(self._render(system, prompt)).input_ids for system, prompt, _, _, _ in batch]
+        # At least one token per row must be left for generate() to process.
+        shared = min(min(len(ids) for ids in rows) - 1, min(_common_length(rows[0], ids) for ids in rows))
+        cache = self._cached_prefix(rows[0][:shared])
+        if len(rows) > 1:
+            cache.batch_repeat_interleave(len(rows))
+        width = max(len(ids) for ids in rows) - shared
+        pad = self.tokenizer.pad_token_id
+        input_ids = torch.tensor([
+            ids[:shared] + [pad] * (width - len(ids) + shared) + ids[shared:] for ids in rows
+        ])
+        attention_mask = torch.tensor([
+            [1] * shared + [0] * (width - len(ids) + shared) + [1] * (len(ids) - shared) for ids in rows
+        ])
+        constraint = SchemaConstraint(self, [self._grammar(schema) for _, _, schema, _, _ in batch])
+        with torch.no_grad():
+            out = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=cache,
+                logits_processor=self.LogitsProcessorList([constraint]),
+                **self._sampling(temperature),
+                max_new_tokens=HF_MAX_NEW_TOKENS,
+                pad_token_id=pad,
+            )
+        generated = out[:, input_ids.shape[1]:]
+        texts = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+        return [
+            (text, {"input_tokens": len(ids), "output_tokens": self._count(row)})
+            for text, ids, row in zip(texts, rows, generated)
+        ]
+
+    def _count(self, generated) -> int:
+        """
+        Generated tokens, excluding the padding that fills rows which stopped early.
+        """
+        return int((generated != self.tokenizer.pad_token_id).sum())
+
+    def _worker(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + HF_BATCH_WAIT
+            while len(batch) < HF_MAX_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # One generate() call per temperature, since sampling settings apply to the whole batch.
+            groups = {}
+            for request in batch:
+                groups.setdefault(request[3], []).append(request)
+            for temperature, group in groups.items():
+                try:
+                    texts = self._generate(group, temperature)
+                except Exception as e:
+                    for *_, future in group:
+                        future.set_exception(e)
+                    continue
+                for (*_, future), (text, usage) in zip(group, texts):
+                    future.set_result(("{" + text, usage))
+
+
+def get_engine(model: str) -> LocalEngine:
+    if model in UNSUPPORTED_MODELS:
+        raise ValueError(f"{model} is not supported by the local backend")
+    with _engines_lock:
+        if model not in _engines:
+            _engines[model] = LocalEngine(model)
+        return _engines[model]
+
+
+def parse_json_object(text: str) -> dict:
+    """
+    Decode the first JSON object in the generated text, ignoring anything after it.
+    """
+    start = text.find("{")
+    if start < 0:
+        raise ValueError(f"No JSON object in model output: {text[:200]!r}")
+    obj, _ = json.JSONDecoder().raw_decode(text[start:])
+    return obj
+
+
+def generate_structured(system: str, prompt: str, schema, model: str, temperature: float = 0.0, include_usage: bool = False):
+    """
+    Validated `schema` instance, or (instance, token usage) with `include_usage`.
+    """
+    engine = get_engine(model)
+    system = system + Template(JSON_INSTRUCTION).substitute(
+        schema = json.dumps(schema.model_json_schema()),
+    )
+    text, usage = engine.submit(system, prompt, schema.model_json_schema(), temperature).result()
+    try:
+        response = schema.model_validate(parse_json_object(text))
+        return (response, usage) if include_usage else response
+    except ValueError as e:
+        raise ValueError(f"{model} did not return a valid {schema.__name__}: {e}") from e
@@ -0,0 +1,171 @@
+"""
+Streaming structured output.
+
+Provider responses are consumed as text chunks and parsed incrementally, so each top-level
+field of the response schema is available as soon as its JSON value is complete. The time
+to the first `*_prediction` field is recorded, and generation can be cancelled once the
+required numeric fields have arrived. Providers generate fields in schema order, so streams
+request the prediction-first variants of `llm_analogies.stream_schema_map`; with the
+prediction fields last, cancelling would save nothing. Any iterable of strings works as a chunk source,
+including `stub_chunks` for local testing.
+"""
+import json
+import time
+
+
+class PartialJSON:
+    """
+    Incremental parser for one JSON object; `feed` returns the top-level fields completed by a chunk.
+    A scalar value is complete at the `,` or `}` after it, an object or array value at its own
+    closing bracket.
+    """
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.member_start = None
+        self.fields = {}
+
+    def feed(self, chunk: str) -> dict:
+        self.text += chunk
+        new = {}
+        for i in range(self.pos, len(self.text)):
+            c = self.text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+            elif c == '"':
+                self.in_string = True
+            elif c in "{[":
+                self.depth += 1
+                if self.depth == 1:
+                    self.member_start = i + 1
+            elif c in "}]":
+                if self.depth == 1:
+                    self._close_member(i, new)
+                elif self.depth == 2:
+                    # An object or array value is complete at its own closing bracket.
+                    self._close_member(i + 1, new)
+                    self.member_start = None
+                self.depth -= 1
+            elif c == "," and self.depth == 1:
+                self._close_member(i, new)
+                self.member_start = i + 1
+        self.pos = len(self.text)
+        self.fields.update(new)
+        return new
+
+    def _close_member(self, end, new):
+        if self.member_start is None:
+            return
+        member = self.text[self.member_start:end].strip()
+        if member:
+            new.update(json.loads("{" + member + "}"))
+
+
+def prediction_fields(schema) -> set:
+    return {name for name in schema.model_fields if name.endswith("_prediction")}
+
+
+def stream_structured(chunks, schema, required=None, cancel_early=False, on_field=None):
+    """
+    Parse a stream of text chunks into `schema`.
+    Returns (response, timings) where timings holds `time_to_first_prediction`, `total_time` and
+    `cancelled`. With `cancel_early`, the stream is closed as soon as every `required` field
+    (by default the schema's prediction fields) is complete, and any text fields not yet
+    generated are left empty.
+    """
+    required = prediction_fields(schema) if required is None else set(required)
+    parser = PartialJSON()
+    start = time.perf_counter()
+    first_prediction = None
+    cancelled = False
+    for chunk in chunks:
+        for name, value in parser.feed(chunk).items():
+            if on_field is not None:
+                on_field(name, value)
+            if first_prediction is None and name.endswith("_prediction"):
+                first_prediction = time.perf_counter() - start
+        if cancel_early and required <= parser.fields.keys():
+            cancelled = True
+            break
+    if hasattr(chunks, "close"):
+        # Closing the generator closes the provider's HTTP stream, which stops generation.
+        chunks.close()
+
+    fields = dict(parser.fields)
+    if cancelled:
+        for name, field in schema.model_fields.items():
+            if field.is_required() and name not in fields:
+                fields[name] = ""
+    timings = {
+        "time_to_first_prediction": first_prediction,
+        "total_time": time.perf_counter() - start,
+        "cancelled": cancelled,
+    }
+    return schema.model_validate(fields), timings
+
+
+def chunk_text(chunk) -> str:
+    """
+    Text of one langchain message chunk: tool-call argument deltas, or the content itself.
+    """
+    tool_call_chunks = getattr(chunk, "tool_call_chunks", None)
+    if tool_call_chunks:
+        return "".join(c.get("args") or "" for c in tool_call_chunks)
+    content = chunk.content
+    if isinstance(content, str):
+        return content
+    return "".join(
+        block.get("text") or block.get("partial_json") or ""
+        for block in content if isinstance(block, dict)
+    )
+
+
+def langchain_chunks(runnable, messages, usage=None):
+    """
+    Text chunks of `runnable.stream`; the token counts the chunks report are summed into `usage`.
+    """
+    stream = runnable.stream(messages)
+    try:
+        for chunk in stream:
+            if usage is not None and getattr(chunk, "usage_metadata", None):
+                for key in ("input_tokens", "output_tokens"):
+                    usage[key] = usage.get(key, 0) + chunk.usage_metadata.get(key, 0)
+            yield chunk_text(chunk)
+    finally:
+        stream.close()
+
+
+def stub_chunks(text: str, chunk_size: int = 8, delay: float = 0.0):
+    """
+    Local stand-in for a provider stream: yields `text` in fixed-size pieces.
+    """
+    for i in range(0, len(text), chunk_size):
+        if delay:
+            time.sleep(delay)
+        yield text[i:i + chunk_size]
+
+
+if __name__ == "__main__":
+    from llm_analogies import BandGapStreamResponse
+
+    sample = json.dumps({
+        "band_gap_prediction": 4.71,
+        "analogy": "PrBrO is to PrClO as NdBrO is to NdClO, so the Br -> Cl shift of +0.24 eV applies.",
+        "code": None,
+        "math": None,
+    })
+    response, timings = stream_structured(
+        stub_chunks(sample, delay=0.01),
+        BandGapStreamResponse,
+        cancel_early=True,
+        on_field=lambda name, value: print(f"{name} ready: {value!r}"),
+    )
+    print(response.band_gap_prediction, timings)
@@ -1,8 +1,4 @@
 import argparse
-import itertools as it
-import pandas as pd
-from parse_and_prompt import main_loop
-from pymatgen.core.composition import Composition
 # from grading import Grading
 
 property_options = ["band_gap", "formation_energy", "volume", "all"]
@@ -50,18 +46,120 @@ def get_arguments():
         "-m",
         "--model",
         type = str,
-        help = "LLM Model to use"
+        help = "LLM Model to use; cascade-<model> escalates from the family's cheapest model up to <model>, analogy-engine answers without a model"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--stream",
+        action = "store_true",
+        help = "Stream structured output and record the time to the first prediction"
+    )
+    parser.add_argument(
+        "--cancel-early",
+        action = "store_true",
+        help = "With --stream, stop generation once every prediction field is complete"
+    )
+    parser.add_argument(
+        "--samples",
+        type = int,
+        default = 1,
+        help = "Sample budget per prompt; above 1, sampling stops early once predictions agree"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type = float,
+        help = "Relative spread at which sampled predictions count as converged (default 0.05)"
+    )
+    parser.add_argument(
+        "--prescreen",
+        action = "store_true",
+        help = "Answer queries with the numeric analogy engine where it is confident, calling the model otherwise"
+    )
+    parser.add_argument(
+        "--leave-one-out",
+        action = "store_true",
+        help = "Predict every material of the dataset in turn, masked from the support data"
+    )
+    parser.add_argument(
+        "--shard-index",
+        type = int,
+        default = 0,
+        help = "Leave-one-out shard run by this process (0-based)"
+    )
+    parser.add_argument(
+        "--shard-count",
+        type = int,
+        default = 1,
+        help = "Total number of leave-one-out shards"
+    )
+    parser.add_argument(
+        "--pack-size",
+        type = int,
+        default = 1,
+        help = "Leave-one-out: predict this many masked materials per request against a shared support table"
+    )
+    parser.add_argument(
+        "--merge",
+        action = "store_true",
+        help = "Merge finished leave-one-out shards into one result file"
+    )
+    arguments = parser.parse_args()
+    check_packing(parser, arguments)
+    return arguments
+
+
+def check_packing(parser, arguments):
+    """
+    Packed requests share one prompt across materials, so per-query options cannot apply to them.
+    """
+    if arguments.pack_size <= 1:
+        return
+    if not (arguments.leave_one_out or arguments.merge):
+        parser.error("--pack-size only applies with --leave-one-out or --merge")
+    conflicts = [
+        flag for flag, used in [
+            ("--stream", arguments.stream),
+            ("--cancel-early", arguments.cancel_early),
+            ("--samples", arguments.samples > 1),
+            ("--tolerance", arguments.tolerance is not None),
+            ("--prescreen", arguments.prescreen),
+        ] if used
+    ]
+    if conflicts:
+        parser.error(f"--pack-size cannot be combined with {', '.join(conflicts)}")
+    from llm_inference import get_model_family
+    if arguments.model and get_model_family(arguments.model) not in ("anthropic", "huggingface", "openai"):
+        parser.error(f"--pack-size does not support the model {arguments.model}")
 
 
 def main():
     arguments = get_arguments()
+    from parse_and_prompt import leave_one_out, main_loop, merge_loo_shards
+
     dataset = arguments.dataset
     material = arguments.crystal
     chem_property = arguments.property
     model = arguments.model
-    main_loop(dataset, material, chem_property, model)
+    inference_options = {
+        "stream": arguments.stream,
+        "cancel_early": arguments.cancel_early,
+        "samples": arguments.samples,
+        "tolerance": arguments.tolerance,
+        "prescreen": arguments.prescreen,
+    }
+    if arguments.merge:
+        merge_loo_shards(dataset, chem_property, model, arguments.pack_size)
+    elif arguments.leave_one_out:
+        leave_one_out(
+            dataset,
+            chem_property,
+            model,
+            arguments.shard_index,
+            arguments.shard_count,
+            arguments.pack_size,
+            **inference_options,
+        )
+    else:
+        main_loop(dataset, material, chem_property, model, **inference_options)
 
 
 if __name__ == "__main__":
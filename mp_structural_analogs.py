@@ -1,12 +1,10 @@
-import pandas as pd
+from __future__ import annotations
 
-from api_key import MATERIALS_PROJECT_API_KEY as mp_api_key
-from mp_api.client import MPRester
-from pymatgen.analysis.structure_matcher import StructureMatcher
-from pymatgen.core.structure import Structure
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from math import inf
-from tqdm import tqdm
+from typing import TYPE_CHECKING, Iterable, Iterator
+
+if TYPE_CHECKING:
+    from pymatgen.core.structure import Structure
 
 SM_LTOL   = 0.35
 SM_STOL   = 0.60
@@ -14,8 +12,30 @@ SM_ANGTOL = 10.0
 RMS_MAX   = 0.30
 ANONYMOUS = True
 
+# Fast first tier: no supercell search and tighter tolerances.
+# Candidates it cannot match escalate to the full matcher above.
+TIERED         = True
+FAST_LTOL      = 0.20
+FAST_STOL      = 0.30
+FAST_ANGTOL    = 5.0
+
+REFRESH_DIR = "datasets/refresh"
+
+# Only the fields the comparison reads are downloaded, one page of documents at a time.
+CANDIDATE_FIELDS = [
+    "material_id",
+    "formula_pretty",
+    "structure",
+    "band_gap",
+    "formation_energy_per_atom",
+]
+CANDIDATE_PAGE_SIZE = 500
+
+
+def materials_project_downloads(mp_id: str) -> tuple[int, str, Structure, Iterator]:
+    from api_key import MATERIALS_PROJECT_API_KEY as mp_api_key
+    from mp_api.client import MPRester
 
-def materials_project_downloads(mp_id: str) -> tuple[int, str, Structure, list]:
     with MPRester(api_key = mp_api_key) as mpr:
         reference_summary = mpr.materials.summary.search(
             material_ids = [mp_id],
@@ -28,13 +48,36 @@ def materials_project_downloads(mp_id: str) -> tuple[int, str, Structure, list]:
         reference_formula_anonymous = getattr(reference_summary, "formula_anonymous", None)
         reference_space_group = getattr(reference_summary.symmetry, "number", None)
         reference_structure = getattr(reference_summary, "structure", None)
-        candidate_materials = mpr.materials.summary.search(
-            spacegroup_number = reference_space_group
-            )
+    candidate_materials = iter_candidate_materials(reference_space_group)
     return reference_space_group, reference_formula_anonymous, reference_structure, candidate_materials
 
 
+def iter_candidate_materials(space_group: int, page_size: int = CANDIDATE_PAGE_SIZE) -> Iterator:
+    """
+    Yield the space group's summary documents, restricted to CANDIDATE_FIELDS, one page at a time.
+    Only the material ids are listed up front, so memory stays flat however large the space group is.
+    """
+    from api_key import MATERIALS_PROJECT_API_KEY as mp_api_key
+    from mp_api.client import MPRester
+
+    with MPRester(api_key = mp_api_key) as mpr:
+        material_ids = [
+            doc.material_id
+            for doc in mpr.materials.summary.search(
+                spacegroup_number = space_group,
+                fields = ["material_id"]
+                )
+        ]
+        for start in range(0, len(material_ids), page_size):
+            yield from mpr.materials.summary.search(
+                material_ids = material_ids[start:start + page_size],
+                fields = CANDIDATE_FIELDS
+                )
+
+
 def norm_struct(s: Structure, symprec = 1e-2, angle_tol = 10) -> Structure:
+    from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
     try:
         s_conv = SpacegroupAnalyzer(
             s,
@@ -47,82 +90,306 @@ def norm_struct(s: Structure, symprec = 1e-2, angle_tol = 10) -> Structure:
         return s_prim.get_sorted_structure()
 
 
+def _matchers():
+    from pymatgen.analysis.structure_matcher import StructureMatcher
+
+    sm = StructureMatcher(
+        ltol=SM_LTOL,
+        stol=SM_STOL,
+        angle_tol=SM_ANGTOL,
+        primitive_cell=True,
+        scale=True,
+        attempt_supercell=True
+    )
+    fast_sm = StructureMatcher(
+        ltol=FAST_LTOL,
+        stol=FAST_STOL,
+        angle_tol=FAST_ANGTOL,
+        primitive_cell=True,
+        scale=True,
+        attempt_supercell=False
+    )
+    return sm, fast_sm
+
+
+def _tiered_match(reference_structure, cand, matchers, tiered) -> tuple[bool, float | None, str]:
+    """
+    Return (is_fit, RMS Å, tier): with `tiered`, the fast matcher settles clear matches before the full one.
+    """
+    sm, fast_sm = matchers
+    if tiered:
+        is_fit, rms = _match_from_matcher(fast_sm, reference_structure, cand, anonymous=ANONYMOUS)
+        if is_fit:
+            return is_fit, rms, "fast"
+    is_fit, rms = _match_from_matcher(sm, reference_structure, cand, anonymous=ANONYMOUS)
+    return is_fit, rms, "full"
+
+
+def _compare_candidate(doc, reference_structure, reference_key, matchers, tiered, tier_counts):
+    """
+    Match one candidate document against the reference and return its CSV row (None without a structure).
+    """
+    mid   = getattr(doc, "material_id", None)
+    form  = getattr(doc, "formula_pretty", None)
+    entha = getattr(doc, "formation_energy_per_atom", None)
+    bandg = getattr(doc, "band_gap", None)
+    s     = getattr(doc, "structure", None)
+    if s is None:
+        return None
+
+    if tiered and _composition_key(s, anonymous=ANONYMOUS) != reference_key:
+        # No species mapping can make the compositions agree, so neither matcher can fit.
+        tier_counts["composition"] += 1
+        is_fit, rms = False, None
+        lat = s.lattice
+    else:
+        cand = norm_struct(s)
+        lat = cand.lattice
+        is_fit, rms, tier = _tiered_match(reference_structure, cand, matchers, tiered)
+        tier_counts[tier] += 1
+
+    return {
+        "material_id": str(mid),
+        "formula_pretty": form,
+        "is_fit": bool(is_fit),
+        "rms_A": inf if rms is None else rms,
+        "a_A": float(lat.a),
+        "b_A": float(lat.b),
+        "c_A": float(lat.c),
+        "volume_A3": float(lat.volume),
+        "band_gap": bandg,
+        "formation_energy_per_atom": entha
+    }
+
+
+def _print_tiers(tier_counts):
+    print(
+        f"Settled by tier: {tier_counts['composition']} composition, "
+        f"{tier_counts['fast']} fast matcher, {tier_counts['full']} full matcher"
+    )
+
+
+def _is_analogue(df):
+    return (df["rms_A"] <= RMS_MAX) | (df["is_fit"])
+
+
+def _write_analogues(analogues, mp_id, reference_space_group, reference_formula_anonymous) -> str:
+    analogues = analogues.sort_values(["rms_A"])
+    print(f"{len(analogues)} analogues with (RMS ≤ {RMS_MAX} Å) or StructureMatcher fit=True")
+    path = f"datasets/{len(analogues)}_{reference_formula_anonymous}_{reference_space_group}_{mp_id}.csv"
+    analogues.to_csv(path, index=False)
+    return path
+
+
 def structure_comparisions_to_csv(
     mp_id: str,
-    reference_space_group: int,
+    reference_space_group: int | str,
     reference_formula_anonymous: str,
     reference_structure: Structure,
-    candidate_materials: list
+    candidate_materials: Iterable,
+    tiered: bool = TIERED,
     ):
     """
     Filters previously downloaded groups via Pymatgen for structural similarity and exports a CSV.
     There will typically be some number of materials (2~30) that won't be exact matches.
     These will be at the bottom of the CSV, so manually check and cull as needed.
+
+    With `tiered`, candidates whose composition cannot map onto the reference are rejected
+    without matching, a fast matcher settles clear matches, and only the rest go to the full
+    supercell matcher. The number of candidates settled by each tier is printed.
     """
-    sm = StructureMatcher(
-        ltol=SM_LTOL,
-        stol=SM_STOL,
-        angle_tol=SM_ANGTOL,
-        primitive_cell=True,
-        scale=True,
-        attempt_supercell=True
-    )
+    import pandas as pd
+    from tqdm import tqdm
 
-    normalized_structure = norm_struct(reference_structure)
+    matchers = _matchers()
+    reference_key = _composition_key(reference_structure, anonymous=ANONYMOUS)
+    tier_counts = {"composition": 0, "fast": 0, "full": 0}
     rows = []
-    for doc in tqdm(candidates, desc = "Comparing structures"):
-        mid   = getattr(doc, "material_id", None)
-        form  = getattr(doc, "formula_pretty", None)
-        entha = getattr(doc, "formation_energy_per_atom", None)
-        bandg = getattr(doc, "band_gap", None)
-        s     = getattr(doc, "structure", None)
+    signatures = {}
+    for doc in tqdm(candidate_materials, desc = "Comparing structures"):
+        row = _compare_candidate(doc, reference_structure, reference_key, matchers, tiered, tier_counts)
+        if row is None:
+            continue
+        rows.append(row)
+        signatures[row["material_id"]] = structure_signature(doc.structure)
+
+    if tiered:
+        _print_tiers(tier_counts)
+    df = pd.DataFrame(rows)
+    _write_analogues(df[_is_analogue(df)].copy(), mp_id, reference_space_group, reference_formula_anonymous)
+    _save_manifest(mp_id, reference_space_group, reference_formula_anonymous, signatures)
+    return tier_counts
+
+
+def structure_signature(s: Structure) -> str:
+    """
+    Hash of the species, lattice and fractional coordinates, rounded so re-serialisation noise is ignored.
+    """
+    import hashlib
+    import numpy as np
+
+    digest = hashlib.sha1()
+    digest.update(" ".join(str(sp) for sp in s.species).encode())
+    digest.update(np.round(s.lattice.matrix, 4).tobytes())
+    digest.update(np.round(s.frac_coords % 1.0, 4).tobytes())
+    return digest.hexdigest()
+
+
+def _manifest_path(mp_id, reference_space_group, reference_formula_anonymous) -> str:
+    return f"{REFRESH_DIR}/{reference_formula_anonymous}_{reference_space_group}_{mp_id}.manifest.json"
+
+
+def _save_manifest(mp_id, reference_space_group, reference_formula_anonymous, signatures):
+    """
+    Record the structure signature of every compared candidate, analogue or not, for later refreshes.
+    """
+    import json
+    import os
+
+    os.makedirs(REFRESH_DIR, exist_ok=True)
+    with open(_manifest_path(mp_id, reference_space_group, reference_formula_anonymous), "w", encoding="utf-8") as f:
+        json.dump(signatures, f)
+
+
+def _load_manifest(mp_id, reference_space_group, reference_formula_anonymous) -> dict | None:
+    import json
+    import os
+
+    path = _manifest_path(mp_id, reference_space_group, reference_formula_anonymous)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def refresh_dataset(
+    dataset: str,
+    mp_id: str,
+    reference_space_group: int | str,
+    reference_formula_anonymous: str,
+    reference_structure: Structure,
+    candidate_materials: Iterable,
+    tiered: bool = TIERED,
+    ):
+    """
+    Update an existing datasets/<dataset> against a new candidate snapshot.
+    Only added candidates and candidates whose structure changed are matched again; deleted ones are
+    dropped, and band gap / formation energy updates are copied over without matching.
+    Writes the updated dataset and a diff report to datasets/refresh/.
+
+    Structure changes are detected against the manifest written by the previous comparison. Datasets
+    made before manifests existed keep their rows as unchanged and match every other candidate once.
+    """
+    import pandas as pd
+    from tqdm import tqdm
+
+    old = pd.read_csv(f"datasets/{dataset}")
+    old["material_id"] = old["material_id"].astype(str)
+    old = old.set_index("material_id", drop=False)
+    manifest = _load_manifest(mp_id, reference_space_group, reference_formula_anonymous)
+    known = set(manifest) if manifest is not None else set(old.index)
+
+    matchers = _matchers()
+    reference_key = _composition_key(reference_structure, anonymous=ANONYMOUS)
+    tier_counts = {"composition": 0, "fast": 0, "full": 0}
+    kept, matched, report = [], [], []
+    signatures = {}
+    seen = set()
+    for doc in tqdm(candidate_materials, desc = "Refreshing structures"):
+        s = getattr(doc, "structure", None)
         if s is None:
             continue
-        cand = norm_struct(s)
+        mid = str(getattr(doc, "material_id", None))
+        seen.add(mid)
+        signatures[mid] = structure_signature(s)
+        unchanged = mid in known and (manifest is None or manifest[mid] == signatures[mid])
 
-        if ANONYMOUS:
-            is_fit = sm.fit_anonymous(reference_structure, cand)
-        else:
-            is_fit = sm.fit(reference_structure, cand)
-        
-        rms = _rms_from_matcher(sm, reference_structure, cand, anonymous=ANONYMOUS)
-        lat = cand.lattice
-        rows.append({
+        if unchanged:
+            if mid not in old.index:
+                continue
+            row = old.loc[mid].to_dict()
+            updated = False
+            for column in ("band_gap", "formation_energy_per_atom"):
+                value = getattr(doc, column, None)
+                if value is not None and not (pd.notna(row[column]) and float(row[column]) == float(value)):
+                    row[column] = value
+                    updated = True
+            kept.append(row)
+            if updated:
+                report.append({"material_id": mid, "formula_pretty": row["formula_pretty"], "change": "properties_updated"})
+            continue
+
+        row = _compare_candidate(doc, reference_structure, reference_key, matchers, tiered, tier_counts)
+        matched.append(row)
+        report.append({
             "material_id": mid,
-            "formula_pretty": form,
-            "is_fit": bool(is_fit),
-            "rms_A": inf if rms is None else rms,
-            "a_A": float(lat.a),
-            "b_A": float(lat.b),
-            "c_A": float(lat.c),
-            "volume_A3": float(lat.volume),
-            "band_gap": bandg,
-            "formation_energy_per_atom": entha
+            "formula_pretty": row["formula_pretty"],
+            "change": "changed" if mid in known else "added",
         })
-    
-    df = pd.DataFrame(rows).sort_values(["rms_A"])
-    analogues = df[(df["rms_A"] <= RMS_MAX) | (df["is_fit"])].copy()
-    print(f"{len(analogues)} analogues with (RMS ≤ {RMS_MAX} Å) or StructureMatcher fit=True")
-    analogues.to_csv(f"datasets/{len(analogues)}_{reference_formula_anonymous}_{reference_space_group}_{mp_id}.csv", index=False)
 
+    for mid in sorted(known - seen):
+        if mid in old.index:
+            report.append({"material_id": mid, "formula_pretty": old.loc[mid, "formula_pretty"], "change": "removed"})
+
+    if tiered and matched:
+        _print_tiers(tier_counts)
+    matched = pd.DataFrame(matched, columns=list(old.columns))
+    if len(matched):
+        matched = matched[_is_analogue(matched)]
+    kept = pd.DataFrame(kept, columns=list(old.columns))
+    analogues = pd.concat([df for df in (kept, matched) if len(df)] or [kept], ignore_index=True)
+    report = pd.DataFrame(report, columns=["material_id", "formula_pretty", "change"])
+    report["in_dataset"] = report["material_id"].isin(analogues["material_id"])
+
+    path = _write_analogues(analogues, mp_id, reference_space_group, reference_formula_anonymous)
+    _save_manifest(mp_id, reference_space_group, reference_formula_anonymous, signatures)
+    report_path = f"{REFRESH_DIR}/{reference_formula_anonymous}_{reference_space_group}_{mp_id}.report.csv"
+    report.to_csv(report_path, index=False)
+    print(report["change"].value_counts().to_string())
+    print(f"Diff report written to {report_path}")
+    return path, report
 
-def _rms_from_matcher(sm, a, b, anonymous: bool):
+
+def _composition_key(s: Structure, anonymous: bool) -> str:
+    """
+    Reduced (anonymized) formula; structures with different keys can never fit.
+    """
+    comp = s.composition
+    return comp.anonymized_formula if anonymous else comp.reduced_formula
+
+
+def _match_from_matcher(sm, a, b, anonymous: bool) -> tuple[bool, float | None]:
     """
-    Return RMS Å if available; tolerate tuple/float/None across pmg versions.
+    Return (is_fit, RMS Å) from a single mapping search. is_fit follows pymatgen's strict
+    match, some mapping with every paired site closer than stol, and the RMS is that of the
+    lowest-RMS mapping, which need not be the one that fits. Falls back to the public
+    fit_anonymous/get_rms_anonymous pair if the private search methods are missing.
     """
     try:
-        if anonymous and hasattr(sm, "get_rms_anonymous"):
-            res = sm.get_rms_anonymous(a, b)
-        else:
+        if not anonymous:
             res = sm.get_rms_dist(a, b)
-        if res is None:
-            return None
-        return float(res[0] if isinstance(res, (tuple, list)) else res)
+            if res is None:
+                return False, None
+            return sm.fit(a, b), float(res[0])
+        if not all(hasattr(sm, name) for name in ("_process_species", "_preprocess", "_anonymous_match")):
+            rms = sm.get_rms_anonymous(a, b)[0]
+            return sm.fit_anonymous(a, b), None if rms is None else float(rms)
+        s1, s2 = sm._process_species([a, b])
+        s1, s2, fu, s1_supercell = sm._preprocess(s1, s2)
+        matches = sm._anonymous_match(s1, s2, fu, s1_supercell, use_rms=True, break_on_match=False)
+        if not matches:
+            return False, None
+        is_fit = any(max(m[1]) < sm.stol for _, m in matches)
+        return is_fit, float(min(m[0] for _, m in matches))
     except Exception:
-        return None
+        return False, None
 
 
 if __name__ == "__main__":
     testing_mp_id = "mp-" + input(str("Enter a material id: mp-"))
+    existing_dataset = input(str("Existing dataset to refresh (blank for a new one): datasets/")).strip()
     group, formula_anonymous, structure, candidates = materials_project_downloads(testing_mp_id)
-    structure_comparisions_to_csv(testing_mp_id, group, formula_anonymous, structure, candidates)
\ No newline at end of file
+    if existing_dataset:
+        refresh_dataset(existing_dataset, testing_mp_id, group, formula_anonymous, structure, candidates)
+    else:
+        structure_comparisions_to_csv(testing_mp_id, group, formula_anonymous, structure, candidates)
\ No newline at end of file
@@ -1,11 +1,22 @@
+import dataset_cache
+import glob
+import hashlib
 import itertools as it
 import json
+import os
 import pandas as pd
-from llm_inference import run_inference
+import re
+import time
+from functools import lru_cache
+from llm_inference import run_inference, run_packed_inference
 from pymatgen.core.composition import Composition
 from tqdm import tqdm
 
 
+LOO_DIR = "output-materials/loo"
+ENGINE_MODEL = "analogy-engine"
+
+
 def dict_power_set(dictionary):
     items = list(dictionary.items())
     return [
@@ -22,36 +33,238 @@ def conditional_df(df, ref_dict):
     return df[~dropped_rows].reset_index(drop=True)
 
 
-def main_loop(dataset, ref_formula, chem_property, model):
-    df = pd.read_csv(f"datasets/{dataset}")
+def table_fingerprint(df):
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+
+
+PROPERTY_COLUMNS = {
+    "band_gap": ["formula_pretty", "band_gap"],
+    "formation_energy": ["formula_pretty", "formation_energy_per_atom"],
+    "volume": ["formula_pretty", "a_A", "b_A", "c_A", "volume_A3"],
+    "all": [
+        "formula_pretty",
+        "band_gap",
+        "formation_energy_per_atom",
+        "a_A",
+        "b_A",
+        "c_A",
+        "volume_A3",
+    ],
+}
+
+
+@lru_cache(maxsize=None)
+def load_dataset(dataset):
+    """
+    Load datasets/<dataset> once per process from the columnar cache, with each row's
+    element-amount dict taken from the precomputed matrix.
+    The cached frame is shared, so callers must not modify it in place.
+    """
+    df, elements, amounts = dataset_cache.load_dataset(f"datasets/{dataset}")
+    df = df.copy(deep=False)
+    df["comp"] = [
+        {el: float(amt) for el, amt in zip(elements, row) if amt}
+        for row in amounts
+    ]
+    return df
+
+
+def predict_subsets(dataset, ref_formula, chem_property, model, prescreen=False, **inference_options):
+    """
+    Yield (subset, response) for every subset in the power set of the reference composition,
+    with the reference masked from the dataset. Each distinct support table is queried once.
+    `inference_options` are passed through to `run_inference`. With `prescreen`, support tables
+    on which the numeric analogy engine is confident are answered by it instead of the model;
+    the model name `analogy-engine` answers every table with it.
+    """
     ref_elements = Composition(ref_formula).get_el_amt_dict()
     ref_power_set = dict_power_set(ref_elements)
-    df["comp"] = df["formula_pretty"].apply(lambda f: Composition(f).get_el_amt_dict())
-    mask = df["formula_pretty"].apply(lambda f: Composition(f).get_el_amt_dict() != ref_elements)
+    df = load_dataset(dataset)
+    mask = df["comp"].apply(lambda comp: comp != ref_elements)
     df = df[mask].reset_index(drop=True)
+    out_cols = PROPERTY_COLUMNS[chem_property]
 
-    if chem_property == "band_gap":
-        out_cols=["formula_pretty", "band_gap"]
-    elif chem_property == "formation_energy":
-        out_cols=["formula_pretty", "formation_energy_per_atom"]
-    elif chem_property == "volume":
-        out_cols=["formula_pretty", "a_A", "b_A", "c_A", "volume_A3"]
-    elif chem_property == "all":
-        out_cols=[
-            "formula_pretty",
-            "band_gap",
-            "formation_energy_per_atom",
-            "a_A",
-            "b_A",
-            "c_A",
-            "volume_A3",
-        ]
+    engine = None
+    if prescreen or model == ENGINE_MODEL:
+        from analogy_engine import get_engine
+        engine = get_engine(dataset)
 
+    responses = {}
+    screened = 0
     for ref_dict in tqdm(ref_power_set, desc = "Querying with data combinations"):
         trimmed_df = conditional_df(df, ref_dict)[out_cols]
-        output = run_inference(trimmed_df, ref_formula, chem_property, model)
+        # Subsets that remove the same rows give the same prompt; query each support table once.
+        key = table_fingerprint(trimmed_df)
+        if key not in responses:
+            estimate = engine.predict(ref_formula, chem_property, exclude=ref_dict) if engine else None
+            if estimate is not None and (model == ENGINE_MODEL or estimate["confident"]):
+                responses[key] = estimate["response"]
+                screened += 1
+            else:
+                responses[key] = run_inference(trimmed_df, ref_formula, chem_property, model, **inference_options)
+        yield ref_dict, responses[key]
+    saved = len(ref_power_set) - len(responses)
+    print(f"{len(responses)} distinct support tables for {len(ref_power_set)} subsets ({saved} calls saved)")
+    if engine is not None and model != ENGINE_MODEL:
+        print(f"{screened} of {len(responses)} support tables answered by the analogy engine")
+
+
+def main_loop(dataset, ref_formula, chem_property, model, **inference_options):
+    outputs = []
+    for ref_dict, output in predict_subsets(dataset, ref_formula, chem_property, model, **inference_options):
         with open (f"output-materials/{ref_formula}_{chem_property}_{model}.jsonl", "a", encoding = "utf-8") as f:
             f.write(output.model_dump_json(indent=2) + "\n")
+        outputs.append((ref_dict, output))
+    return outputs
+
+
+def _loo_prefix(dataset, chem_property, model, pack_size=1):
+    stem = os.path.splitext(dataset)[0]
+    pack = f"_pack{pack_size}" if pack_size > 1 else ""
+    return f"{LOO_DIR}/{stem}_{chem_property}_{model.replace('/', '_')}{pack}"
+
+
+def loo_shard_path(dataset, chem_property, model, shard_index, shard_count, pack_size=1):
+    return f"{_loo_prefix(dataset, chem_property, model, pack_size)}_shard{shard_index}of{shard_count}.jsonl"
+
+
+def _read_records(path, repair=True):
+    """
+    Records of a shard file. A kill during a write leaves a partial last line, which is skipped.
+    With `repair`, the file is also rewritten without the records of the material that partial
+    line belongs to, read from the name each record line starts with, so that material reruns.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        data = f.read()
+    complete = data[:data.rfind(b"\n") + 1]
+    records = [json.loads(line) for line in complete.splitlines() if line.strip()]
+    if complete == data or not repair:
+        return records
+    named = re.match(rb'\{"material": ("(?:[^"\\]|\\.)*")', data[len(complete):])
+    # A tail cut inside the name: fall back to the last complete record, at worst rerunning it.
+    torn = json.loads(named.group(1)) if named else records[-1]["material"] if records else None
+    records = [record for record in records if record["material"] != torn]
+    print(f"[loo] {path}: dropped an interrupted write{f' of {torn}' if torn else ''}")
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with open(tmp, "w", encoding = "utf-8") as f:
+        f.writelines(json.dumps(record) + "\n" for record in records)
+    os.replace(tmp, path)
+    return records
+
+
+def leave_one_out(dataset, chem_property, model, shard_index=0, shard_count=1, pack_size=1, **inference_options):
+    """
+    Mask each material of the dataset in turn and predict it under every perturbation subset.
+    Materials are dealt round-robin to `shard_count` shards and this call runs `shard_index`,
+    so shards can run in separate processes or on separate machines. One JSON record per
+    (material, subset) is appended to the shard file; materials already in it are skipped on rerun.
+    With `pack_size` > 1, see `leave_packs_out`.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"shard index {shard_index} is outside 0..{shard_count - 1}")
+    df = load_dataset(dataset)
+    truth_cols = PROPERTY_COLUMNS[chem_property][1:]
+    truths = df.drop_duplicates("formula_pretty").set_index("formula_pretty")[truth_cols]
+    materials = list(truths.index)[shard_index::shard_count]
+
+    os.makedirs(LOO_DIR, exist_ok = True)
+    path = loo_shard_path(dataset, chem_property, model, shard_index, shard_count, pack_size)
+    done = {record["material"] for record in _read_records(path)}
+    print(f"Shard {shard_index}/{shard_count}: {len(materials)} materials, {len(done)} already done")
+    if pack_size > 1:
+        pending = [material for material in materials if material not in done]
+        return leave_packs_out(dataset, chem_property, model, pending, truths, path, pack_size)
+
+    for material in tqdm(materials, desc = "Leave-one-out materials"):
+        if material in done:
+            continue
+        truth = {col: float(truths.at[material, col]) for col in truth_cols}
+        lines = [
+            json.dumps({
+                "material": material,
+                "subset": ref_dict,
+                "truth": truth,
+                "prediction": output.model_dump(),
+            })
+            for ref_dict, output in predict_subsets(dataset, material, chem_property, model, **inference_options)
+        ]
+        # One write per material; if it is cut short, _read_records drops the material on rerun.
+        with open(path, "a", encoding = "utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+    return path
+
+
+def leave_packs_out(dataset, chem_property, model, materials, truths, path, pack_size):
+    """
+    Packed leave-one-out: groups of `pack_size` materials are masked together and predicted in one
+    request against the shared, unperturbed support table, then unpacked into one record each.
+    Prints the provider-reported input and output tokens per prediction and the throughput.
+    """
+    df = load_dataset(dataset)
+    out_cols = PROPERTY_COLUMNS[chem_property]
+    truth_cols = out_cols[1:]
+    predictions = requests = 0
+    tokens = {"input_tokens": 0, "output_tokens": 0}
+    start = time.perf_counter()
+    for i in tqdm(range(0, len(materials), pack_size), desc = "Packed requests"):
+        pack = materials[i:i + pack_size]
+        pack_elements = [Composition(material).get_el_amt_dict() for material in pack]
+        mask = df["comp"].apply(lambda comp: comp not in pack_elements)
+        support = df[mask].reset_index(drop=True)[out_cols]
+        responses, usage = run_packed_inference(support, pack, chem_property, model)
+        requests += 1
+        for key in tokens:
+            tokens[key] += usage.get(key) or 0
+
+        lines = []
+        for material, response in zip(pack, responses):
+            if response is None:
+                print(f"[packed] no prediction returned for {material}; it will be retried on rerun")
+                continue
+            predictions += 1
+            lines.append(json.dumps({
+                "material": material,
+                "subset": {},
+                "pack": pack,
+                "truth": {col: float(truths.at[material, col]) for col in truth_cols},
+                "prediction": response.model_dump(),
+            }))
+        if lines:
+            with open(path, "a", encoding = "utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+
+    elapsed = time.perf_counter() - start
+    if predictions:
+        print(
+            f"{predictions} predictions in {requests} requests: "
+            f"{tokens['input_tokens'] / predictions:.0f} input and "
+            f"{tokens['output_tokens'] / predictions:.0f} output tokens per prediction, "
+            f"{predictions / elapsed:.2f} predictions/s"
+        )
+    return path
+
+
+def merge_loo_shards(dataset, chem_property, model, pack_size=1):
+    """
+    Combine every shard file of a leave-one-out run into one JSON-lines file in dataset order.
+    """
+    prefix = _loo_prefix(dataset, chem_property, model, pack_size)
+    records = {}
+    for path in sorted(glob.glob(f"{glob.escape(prefix)}_shard*of*.jsonl")):
+        for record in _read_records(path, repair = False):
+            records[(record["material"], json.dumps(record["subset"], sort_keys = True))] = record
+
+    order = {formula: i for i, formula in enumerate(load_dataset(dataset)["formula_pretty"].drop_duplicates())}
+    merged = sorted(records.values(), key = lambda r: (order.get(r["material"], len(order)), len(r["subset"])))
+    path = f"{prefix}.jsonl"
+    with open(path, "w", encoding = "utf-8") as f:
+        for record in merged:
+            f.write(json.dumps(record) + "\n")
+    missing = len(order) - len({r["material"] for r in merged})
+    print(f"Merged {len(merged)} records into {path} ({missing} materials missing)")
+    return path
 
 
 if __name__ == "__main__":
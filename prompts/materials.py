@@ -51,4 +51,34 @@ $df
 USER_ALL = """
 Predict the band gap (units: electronvolts), formation energy (units: electronvolts per atom), and lattice parameters/volume (units: angstroms) of:
 $material
-"""
\ No newline at end of file
+"""
+
+# packed: several query materials share one support table
+USER_BAND_GAP_PACKED = """
+Predict the band gap (units: electronvolts) of each of these materials:
+$materials
+
+Analogues:
+$df
+"""
+
+USER_FORMATION_ENERGY_PACKED = """
+Predict the formation energy (units: electronvolts per atom) of each of these materials:
+$materials
+
+Analogues:
+$df
+"""
+
+USER_VOLUME_PACKED = """
+Predict the lattice parameters/volume (units: angstroms) of each of these materials:
+$materials
+
+Analogues:
+$df
+"""
+
+USER_ALL_PACKED = """
+Predict the band gap (units: electronvolts), formation energy (units: electronvolts per atom), and lattice parameters/volume (units: angstroms) of each of these materials:
+$materials
+"""
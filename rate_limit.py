@@ -0,0 +1,114 @@
+"""
+Shared token-bucket governor for provider calls.
+
+Every process on the machine draws from the same per-(provider, model) request and token
+buckets, stored in one SQLite file, so concurrent workers together stay just under quota.
+Token costs are estimated from the prompt text before the call. A rate-limit error from the
+provider empties the buckets so that every worker backs off, not only the one that got it.
+"""
+import sqlite3
+import time
+from contextlib import contextmanager
+
+RATE_LIMIT_DB = ".rate_limits.sqlite"
+
+# (provider, model): (requests per minute, tokens per minute)
+QUOTAS = {
+    ("anthropic", "claude-3-7-sonnet-20250219"): (50, 40_000),
+    ("openai", "gpt-5"): (500, 500_000),
+    ("openai", "gpt-5-mini"): (500, 500_000),
+    ("openai", "gpt-5-nano"): (500, 200_000),
+}
+DEFAULT_QUOTA = (60, 100_000)
+HEADROOM = 0.9                  # fraction of the quota the buckets allow
+CHARS_PER_TOKEN = 4
+OUTPUT_TOKEN_ALLOWANCE = 2_000  # expected completion tokens per request
+
+
+def estimate_tokens(*texts: str) -> int:
+    return sum(len(text) for text in texts) // CHARS_PER_TOKEN + OUTPUT_TOKEN_ALLOWANCE
+
+
+def _connect():
+    conn = sqlite3.connect(RATE_LIMIT_DB, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS buckets ("
+        "key TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL)"
+    )
+    return conn
+
+
+def _capacity(provider: str, model: str) -> tuple[float, float]:
+    rpm, tpm = QUOTAS.get((provider, model), DEFAULT_QUOTA)
+    return rpm * HEADROOM, tpm * HEADROOM
+
+
+def acquire(provider: str, model: str, tokens: int):
+    """
+    Block until one request and `tokens` tokens are available for (provider, model), then take them.
+    """
+    key = f"{provider}/{model}"
+    request_capacity, token_capacity = _capacity(provider, model)
+    tokens = min(tokens, token_capacity)  # a single oversized prompt must still get through
+    while True:
+        conn = _connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT requests, tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is None:
+                requests, available = request_capacity, token_capacity
+            else:
+                elapsed = max(now - row[2], 0.0)
+                requests = min(request_capacity, row[0] + elapsed * request_capacity / 60)
+                available = min(token_capacity, row[1] + elapsed * token_capacity / 60)
+            granted = requests >= 1 and available >= tokens
+            if granted:
+                requests -= 1
+                available -= tokens
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, requests, tokens, updated) VALUES (?, ?, ?, ?)",
+                (key, requests, available, now),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        if granted:
+            return
+        wait = max(
+            (1 - requests) * 60 / request_capacity,
+            (tokens - available) * 60 / token_capacity,
+            0.05,
+        )
+        time.sleep(wait)
+
+
+def drain(provider: str, model: str):
+    """
+    Empty both buckets after a rate-limit error so all workers pause until they refill.
+    """
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (key, requests, tokens, updated) VALUES (?, 0, 0, ?)",
+            (f"{provider}/{model}", time.time()),
+        )
+    finally:
+        conn.close()
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+    return status == 429 or "rate limit" in str(e).lower() or "429" in str(e)
+
+
+@contextmanager
+def governed(provider: str, model: str, *texts: str):
+    acquire(provider, model, estimate_tokens(*texts))
+    try:
+        yield
+    except Exception as e:
+        if is_rate_limit_error(e):
+            drain(provider, model)
+        raise
@@ -0,0 +1,123 @@
+"""
+Adaptive self-consistency sampling.
+
+Samples for one prompt are issued in parallel rounds until every numeric prediction agrees
+within tolerance or the sample budget runs out. The result carries the per-field median,
+the spread across samples, how many samples it took and their summed provider token usage.
+Only samples that fail to parse into the schema are skipped; other errors propagate.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median, stdev
+from typing import Optional, Union
+
+from llm_analogies import (
+    AllResponse,
+    BandGapResponse,
+    FormationEnergyResponse,
+    VolumeResponse,
+    prediction_values,
+    with_prediction_values,
+)
+from pydantic import BaseModel, ConfigDict
+
+SAMPLE_ROUND  = 3     # samples issued in parallel per round
+MAX_SAMPLES   = 9
+REL_TOLERANCE = 0.05  # converged when every field's std <= max(ABS, REL * |median|)
+ABS_TOLERANCE = 0.05
+SAMPLE_TEMPERATURE = 0.7  # for the local backend, which otherwise decodes greedily
+
+
+class SampledResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    prediction: Union[AllResponse, BandGapResponse, FormationEnergyResponse, VolumeResponse]
+    spread: dict[str, float]
+    n_samples: int
+    converged: bool
+    usage: dict[str, Optional[int]]  # summed over the parsed samples; None if unreported
+
+
+def _converged(samples, rel_tolerance, abs_tolerance) -> bool:
+    if len(samples) < 2:
+        return False
+    for key in samples[0]:
+        values = [s[key] for s in samples]
+        if stdev(values) > max(abs_tolerance, rel_tolerance * abs(median(values))):
+            return False
+    return True
+
+
+def aggregate(responses) -> tuple[BaseModel, dict[str, float]]:
+    """
+    Median of every prediction field, attached to the sample closest to it, and the per-field std.
+    """
+    samples = [prediction_values(r) for r in responses]
+    medians = {key: median(s[key] for s in samples) for key in samples[0]}
+    spread = {key: stdev(s[key] for s in samples) if len(samples) > 1 else 0.0 for key in samples[0]}
+    scale = {key: max(abs(medians[key]), ABS_TOLERANCE) for key in medians}
+    closest = min(
+        range(len(samples)),
+        key = lambda i: sum(abs(samples[i][key] - medians[key]) / scale[key] for key in medians),
+    )
+    return with_prediction_values(responses[closest], medians), spread
+
+
+def self_consistent_inference(
+    df,
+    material,
+    response_type,
+    model,
+    max_samples = MAX_SAMPLES,
+    rel_tolerance = REL_TOLERANCE,
+    abs_tolerance = ABS_TOLERANCE,
+    **inference_options,
+):
+    from llm_inference import run_inference
+
+    responses = []
+    usages = []
+    failures = 0
+    with ThreadPoolExecutor(SAMPLE_ROUND) as pool:
+        while len(responses) + failures < max_samples:
+            n = min(SAMPLE_ROUND, max_samples - len(responses) - failures)
+            futures = [
+                pool.submit(
+                    run_inference,
+                    df,
+                    material,
+                    response_type,
+                    model,
+                    temperature = SAMPLE_TEMPERATURE,
+                    include_usage = True,
+                    **inference_options,
+                )
+                for _ in range(n)
+            ]
+            for future in futures:
+                try:
+                    response, usage = future.result()
+                except ValueError as e:
+                    # Parse and validation errors (pydantic, JSON, langchain output parsers)
+                    failures += 1
+                    print(f"[sampling] sample failed: {e}")
+                    continue
+                responses.append(response)
+                usages.append(usage)
+            samples = [prediction_values(r) for r in responses]
+            if _converged(samples, rel_tolerance, abs_tolerance):
+                break
+    if not responses:
+        raise ValueError(f"All {failures} samples for {material} failed to parse")
+
+    prediction, spread = aggregate(responses)
+    converged = _converged([prediction_values(r) for r in responses], rel_tolerance, abs_tolerance)
+    print(f"[sampling] {material}: {len(responses)} samples, {'converged' if converged else 'budget reached'}")
+    return SampledResponse(
+        prediction = prediction,
+        spread = spread,
+        n_samples = len(responses),
+        converged = converged,
+        usage = {
+            key: None if any(u.get(key) is None for u in usages) else sum(u[key] for u in usages)
+            for key in ("input_tokens", "output_tokens")
+        },
+    )
@@ -0,0 +1,206 @@
+"""
+Long-running prediction service over HTTP or a Unix socket.
+
+Datasets, parsed compositions and model clients stay cached in this process, and
+identical requests that arrive while one is already running share its result.
+
+POST /predict  {"dataset": "...csv", "crystal": "NdClO", "property": "band_gap", "model": "gpt-5-mini"}
+POST /scent    {"molecule": "benzaldehyde", "csv_file": "datasets/keller_molecules_merged.csv"}
+GET  /health
+
+python server.py --port 8765
+python server.py --socket /tmp/mp-analogies.sock --preload 351_ABC_129_mp-30273.csv
+"""
+import argparse
+import json
+import os
+import socketserver
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCENT_CSV = "datasets/keller_molecules_merged.csv"
+
+
+class Coalescer:
+    """
+    Runs each distinct key once at a time; concurrent callers with the same key wait on the same result.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def run(self, key, fn):
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[key] = future
+        if owner:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+        return future.result()
+
+
+coalescer = Coalescer()
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def _field(request, name):
+    if name not in request:
+        raise BadRequest(f"missing field '{name}'")
+    return request[name]
+
+
+def predict(request):
+    from parse_and_prompt import PROPERTY_COLUMNS, main_loop
+
+    dataset = _field(request, "dataset")
+    crystal = _field(request, "crystal")
+    chem_property = _field(request, "property")
+    model = _field(request, "model")
+    if chem_property not in PROPERTY_COLUMNS:
+        raise BadRequest(f"unknown property '{chem_property}'; expected one of {', '.join(PROPERTY_COLUMNS)}")
+    key = ("predict", dataset, crystal, chem_property, model)
+    outputs = coalescer.run(key, lambda: main_loop(dataset, crystal, chem_property, model))
+    return {
+        "crystal": crystal,
+        "property": chem_property,
+        "model": model,
+        "results": [
+            {"subset": ref_dict, "prediction": output.model_dump()}
+            for ref_dict, output in outputs
+        ],
+    }
+
+
+def predict_scent(request):
+    from fish_script_refactor import predict_one_molecule
+
+    csv_file = request.get("csv_file", SCENT_CSV)
+    molecule = _field(request, "molecule")
+    key = ("scent", csv_file, molecule)
+    prediction = coalescer.run(key, lambda: predict_one_molecule(csv_file, molecule))
+    return {"molecule": molecule, "prediction": prediction}
+
+
+ROUTES = {
+    "/predict": predict,
+    "/scent": predict_scent,
+}
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "in_flight": len(coalescer.in_flight)})
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        route = ROUTES.get(self.path)
+        if route is None:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self._send_json(400, {"error": f"invalid JSON body: {e}"})
+            return
+        try:
+            self._send_json(200, route(request))
+        except BadRequest as e:
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address, so log the request line only.
+        print(f"[server] {format % args}")
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def preload(datasets):
+    """
+    Warm the dataset cache and the inference imports before the first request arrives.
+    """
+    import llm_analogies
+    from parse_and_prompt import load_dataset
+
+    for dataset in datasets:
+        load_dataset(dataset)
+        print(f"Loaded datasets/{dataset}")
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Serve property predictions from a warm process")
+    parser.add_argument(
+        "--host",
+        type = str,
+        default = "127.0.0.1",
+        help = "Address to bind for HTTP"
+    )
+    parser.add_argument(
+        "--port",
+        type = int,
+        default = 8765,
+        help = "Port to bind for HTTP"
+    )
+    parser.add_argument(
+        "--socket",
+        type = str,
+        help = "Serve on this Unix socket path instead of TCP"
+    )
+    parser.add_argument(
+        "--preload",
+        nargs = "*",
+        default = [],
+        help = "Datasets from datasets/ to load at startup"
+    )
+    return parser.parse_args()
+
+
+def main():
+    arguments = get_arguments()
+    preload(arguments.preload)
+    if arguments.socket:
+        if os.path.exists(arguments.socket):
+            os.remove(arguments.socket)
+        server = ThreadingUnixHTTPServer(arguments.socket, PredictionHandler)
+        print(f"Serving on unix:{arguments.socket}")
+    else:
+        server = ThreadingHTTPServer((arguments.host, arguments.port), PredictionHandler)
+        print(f"Serving on http://{arguments.host}:{arguments.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if arguments.socket and os.path.exists(arguments.socket):
+            os.remove(arguments.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+All-pairs structure similarity per space group.
+
+Every material of a space group is matched against every other once, in parallel: each
+unordered pair is computed a single time, and pairs whose compositions cannot map onto each
+other are skipped. The resulting sparse RMS/fit matrix is saved with each material's
+properties, and materials are grouped into prototype families by union-find over the
+analogue pairs. Any reference's analog dataset is then a lookup in the stored matrix.
+
+python similarity_matrix.py build 129
+python similarity_matrix.py lookup mp-30273 129
+python similarity_matrix.py families 129
+"""
+from __future__ import annotations
+
+import argparse
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from mp_structural_analogs import (
+    ANONYMOUS,
+    RMS_MAX,
+    TIERED,
+    _composition_key,
+    _is_analogue,
+    _matchers,
+    _tiered_match,
+    _write_analogues,
+    iter_candidate_materials,
+    norm_struct,
+)
+
+MATRIX_DIR = "snapshots/matrices"
+PAIR_CHUNK = 256
+PROPERTY_FIELDS = ["a_A", "b_A", "c_A", "volume_A3", "band_gap", "formation_energy_per_atom"]
+
+
+def matrix_path(space_group: int) -> str:
+    return os.path.join(MATRIX_DIR, f"sg{space_group}.npz")
+
+
+def _candidate_pairs(keys: np.ndarray) -> np.ndarray:
+    """
+    (i, j) with i < j for every pair of materials that share a composition key.
+    """
+    pairs = []
+    for key in np.unique(keys):
+        members = np.flatnonzero(keys == key)
+        if len(members) > 1:
+            i, j = np.triu_indices(len(members), k=1)
+            pairs.append(np.column_stack([members[i], members[j]]))
+    return np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=int)
+
+
+_worker = {}
+
+
+def _init_worker(structures, tiered):
+    _worker["structures"] = structures
+    _worker["matchers"] = _matchers()
+    _worker["tiered"] = tiered
+
+
+def _match_pairs(pairs):
+    structures = _worker["structures"]
+    results = []
+    for i, j in pairs:
+        is_fit, rms, _ = _tiered_match(structures[i], structures[j], _worker["matchers"], _worker["tiered"])
+        results.append((is_fit, np.inf if rms is None else rms))
+    return pairs, results
+
+
+def build_matrix(space_group: int, candidate_materials=None, processes: int | None = None, tiered: bool = TIERED):
+    """
+    Match every pair of the space group's materials once and save the matrix, the per-material
+    properties and the prototype families to `matrix_path(space_group)`.
+    Candidates are downloaded from the Materials Project unless `candidate_materials` is given.
+    """
+    from tqdm import tqdm
+
+    if candidate_materials is None:
+        candidate_materials = iter_candidate_materials(space_group)
+
+    material_ids, formulas, keys, structures, properties = [], [], [], [], []
+    for doc in tqdm(candidate_materials, desc = "Normalizing structures"):
+        s = getattr(doc, "structure", None)
+        if s is None:
+            continue
+        cand = norm_struct(s)
+        lat = cand.lattice
+        material_ids.append(str(doc.material_id))
+        formulas.append(doc.formula_pretty)
+        keys.append(_composition_key(s, anonymous=ANONYMOUS))
+        structures.append(cand)
+        properties.append([
+            lat.a,
+            lat.b,
+            lat.c,
+            lat.volume,
+            np.nan if getattr(doc, "band_gap", None) is None else doc.band_gap,
+            np.nan if getattr(doc, "formation_energy_per_atom", None) is None else doc.formation_energy_per_atom,
+        ])
+
+    keys = np.asarray(keys)
+    pairs = _candidate_pairs(keys)
+    n = len(structures)
+    print(f"{len(pairs)} pairs to match of {n * (n - 1) // 2} ({n} materials)")
+
+    rms = np.full(len(pairs), np.inf)
+    fit = np.zeros(len(pairs), dtype=bool)
+    chunks = [pairs[start:start + PAIR_CHUNK] for start in range(0, len(pairs), PAIR_CHUNK)]
+    with Pool(processes, initializer=_init_worker, initargs=(structures, tiered)) as pool:
+        done = 0
+        with tqdm(total = len(pairs), desc = "Matching pairs") as bar:
+            for chunk, results in pool.imap(_match_pairs, chunks):
+                fit[done:done + len(chunk)] = [is_fit for is_fit, _ in results]
+                rms[done:done + len(chunk)] = [r for _, r in results]
+                done += len(chunk)
+                bar.update(len(chunk))
+
+    families = prototype_families(n, pairs, fit, rms)
+    os.makedirs(MATRIX_DIR, exist_ok=True)
+    path = matrix_path(space_group)
+    np.savez(
+        path,
+        material_ids=np.asarray(material_ids),
+        formulas=np.asarray(formulas),
+        keys=keys,
+        properties=np.asarray(properties, dtype=float).reshape(-1, len(PROPERTY_FIELDS)),
+        pairs=pairs,
+        rms=rms,
+        fit=fit,
+        families=families,
+    )
+    print(f"Saved the space group {space_group} matrix with {len(np.unique(families))} prototype families to {path}")
+    return path
+
+
+def prototype_families(n: int, pairs: np.ndarray, fit: np.ndarray, rms: np.ndarray) -> np.ndarray:
+    """
+    Family label per material: connected components of the analogue pairs, by union-find.
+    """
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs[fit | (rms <= RMS_MAX)]:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    return np.array([find(i) for i in range(n)])
+
+
+def load_matrix(space_group: int) -> dict:
+    path = matrix_path(space_group)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No matrix for space group {space_group}; run `python similarity_matrix.py build {space_group}`")
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def analogs_from_matrix(mp_id: str, space_group: int) -> str:
+    """
+    Write the analog dataset CSV of `mp_id` from its space group's stored matrix, without matching.
+    """
+    import pandas as pd
+
+    matrix = load_matrix(space_group)
+    index = np.flatnonzero(matrix["material_ids"] == mp_id)
+    if not len(index):
+        raise KeyError(f"{mp_id} is not in the space group {space_group} matrix")
+    index = index[0]
+
+    pairs = matrix["pairs"]
+    touching = (pairs[:, 0] == index) | (pairs[:, 1] == index)
+    others = np.where(pairs[touching, 0] == index, pairs[touching, 1], pairs[touching, 0])
+    members = np.concatenate([[index], others])
+    rms = np.concatenate([[0.0], matrix["rms"][touching]])
+    fit = np.concatenate([[True], matrix["fit"][touching]])
+
+    df = pd.DataFrame({
+        "material_id": matrix["material_ids"][members],
+        "formula_pretty": matrix["formulas"][members],
+        "is_fit": fit,
+        "rms_A": rms,
+    })
+    for k, field in enumerate(PROPERTY_FIELDS):
+        df[field] = matrix["properties"][members, k]
+
+    family = matrix["families"] == matrix["families"][index]
+    print(f"{mp_id} belongs to a prototype family of {family.sum()} materials")
+    return _write_analogues(df[_is_analogue(df)].copy(), mp_id, space_group, matrix["keys"][index])
+
+
+def print_families(space_group: int, top: int = 10):
+    matrix = load_matrix(space_group)
+    labels, counts = np.unique(matrix["families"], return_counts=True)
+    print(f"{len(labels)} prototype families among {len(matrix['material_ids'])} materials")
+    for label, count in sorted(zip(labels, counts), key = lambda item: -item[1])[:top]:
+        members = np.flatnonzero(matrix["families"] == label)
+        examples = ", ".join(matrix["formulas"][members[:5]])
+        print(f"{count:>6}  {matrix['keys'][label]:<10} {matrix['material_ids'][label]:<12} {examples}")
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="All-pairs structure similarity and prototype families per space group")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Match every pair of a space group's materials and save the matrix")
+    build.add_argument(
+        "space_group",
+        type = int,
+        help = "Space group number, e.g. 129"
+    )
+    build.add_argument(
+        "--snapshot",
+        action = "store_true",
+        help = "Read candidates from the structure_index.py snapshot instead of the Materials Project"
+    )
+    build.add_argument(
+        "--processes",
+        type = int,
+        help = "Worker processes for matching (default: all cores)"
+    )
+    lookup = subparsers.add_parser("lookup", help="Write a material's analog dataset from the stored matrix")
+    lookup.add_argument(
+        "mp_id",
+        type = str,
+        help = "Reference material id, e.g. mp-30273"
+    )
+    lookup.add_argument(
+        "space_group",
+        type = int,
+        help = "Space group of the reference"
+    )
+    families = subparsers.add_parser("families", help="Print the largest prototype families of a space group")
+    families.add_argument(
+        "space_group",
+        type = int,
+        help = "Space group number"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = get_arguments()
+    if arguments.command == "build":
+        candidates = None
+        if arguments.snapshot:
+            from structure_index import iter_snapshot
+            candidates = (doc for doc in iter_snapshot() if doc.space_group == arguments.space_group)
+        build_matrix(arguments.space_group, candidates, arguments.processes)
+    elif arguments.command == "lookup":
+        analogs_from_matrix(arguments.mp_id, arguments.space_group)
+    elif arguments.command == "families":
+        print_families(arguments.space_group)
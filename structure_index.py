@@ -0,0 +1,286 @@
+"""
+Cross-space-group analog search over a local snapshot of Materials Project structures.
+
+Each structure gets a fixed-length, scale-invariant, species-anonymous fingerprint
+(radial distribution, first-shell coordination and stoichiometry). Fingerprints are
+hashed into random-hyperplane LSH tables, so a query only scores the few buckets it
+falls into instead of the whole snapshot. Building the index also writes a record store
+with one separately compressed entry per structure, so the reference and the short list
+are read by byte offset instead of scanning the snapshot. The short list is then confirmed
+with StructureMatcher through `structure_comparisions_to_csv`.
+
+python structure_index.py download
+python structure_index.py build
+python structure_index.py query mp-30273 --shortlist 300
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+import zlib
+from multiprocessing import Pool
+from types import SimpleNamespace
+
+import numpy as np
+
+SNAPSHOT_PATH = "snapshots/mp_structures.jsonl.gz"
+INDEX_PATH    = "snapshots/mp_structures.index.npz"
+RECORDS_PATH  = "snapshots/mp_structures.records"
+
+RDF_CUTOFF  = 2.5   # in units of (volume per atom) ** (1/3)
+RDF_BINS    = 25
+CN_TOL      = 0.2   # first shell: neighbours within (1 + CN_TOL) x nearest distance
+CN_MAX      = 12
+MAX_SPECIES = 6
+FINGERPRINT_LENGTH = RDF_BINS + CN_MAX + MAX_SPECIES
+
+LSH_TABLES = 8
+LSH_BITS   = 12
+SHORTLIST  = 200
+SEED       = 0
+
+
+def download_snapshot(path: str = SNAPSHOT_PATH):
+    """
+    Write every Materials Project structure with its properties to a gzipped JSON-lines file,
+    streaming each space group page by page so memory stays bounded.
+    """
+    import os
+    from mp_structural_analogs import iter_candidate_materials
+    from tqdm import tqdm
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for space_group in tqdm(range(1, 231), desc = "Downloading space groups"):
+            for doc in iter_candidate_materials(space_group):
+                f.write(json.dumps({
+                    "material_id": str(doc.material_id),
+                    "formula_pretty": doc.formula_pretty,
+                    "space_group": space_group,
+                    "band_gap": doc.band_gap,
+                    "formation_energy_per_atom": doc.formation_energy_per_atom,
+                    "structure": doc.structure.as_dict(),
+                }) + "\n")
+
+
+def iter_snapshot(path: str = SNAPSHOT_PATH, material_ids=None):
+    """
+    Yield snapshot entries as documents with the attributes `structure_comparisions_to_csv` reads.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if material_ids is not None and entry["material_id"] not in material_ids:
+                continue
+            yield _document(entry)
+
+
+def _document(entry: dict):
+    from pymatgen.core.structure import Structure
+
+    entry["structure"] = Structure.from_dict(entry["structure"])
+    return SimpleNamespace(**entry)
+
+
+def fingerprint(s) -> np.ndarray:
+    """
+    Fixed-length descriptor of a structure, independent of its species labels and scale.
+    """
+    s = s.copy()
+    s.scale_lattice(len(s))  # one atom per unit volume
+    centers, _, _, distances = s.get_neighbor_list(RDF_CUTOFF)
+    keep = distances > 1e-8
+    centers, distances = centers[keep], distances[keep]
+
+    rdf, _ = np.histogram(distances, bins=RDF_BINS, range=(0.0, RDF_CUTOFF))
+    rdf = rdf / len(s)
+
+    cn_hist = np.zeros(CN_MAX)
+    if len(distances):
+        nearest = np.full(len(s), np.inf)
+        np.minimum.at(nearest, centers, distances)
+        in_shell = distances <= (1 + CN_TOL) * nearest[centers]
+        cn = np.bincount(centers[in_shell], minlength=len(s))
+        cn_hist = np.bincount(np.clip(cn, 1, CN_MAX) - 1, minlength=CN_MAX) / len(s)
+
+    fractions = sorted(s.composition.fractional_composition.values(), reverse=True)[:MAX_SPECIES]
+    stoich = np.zeros(MAX_SPECIES)
+    stoich[:len(fractions)] = fractions
+
+    vector = np.concatenate([rdf / max(rdf.sum(), 1e-12), cn_hist, stoich])
+    return vector / max(np.linalg.norm(vector), 1e-12)
+
+
+def _fingerprint_line(line: str):
+    from pymatgen.core.structure import Structure
+
+    entry = json.loads(line)
+    try:
+        vector = fingerprint(Structure.from_dict(entry["structure"]))
+    except Exception:
+        return None
+    return entry["material_id"], vector
+
+
+def build_index(
+    snapshot_path: str = SNAPSHOT_PATH,
+    index_path: str = INDEX_PATH,
+    records_path: str = RECORDS_PATH,
+    processes: int | None = None,
+):
+    from tqdm import tqdm
+
+    offsets, lengths = [], []
+
+    def store(lines, out):
+        # Runs in the pool's feeder thread; line i's record is written before it is dispatched.
+        for line in lines:
+            blob = zlib.compress(line.encode("utf-8"))
+            offsets.append(out.tell())
+            lengths.append(len(blob))
+            out.write(blob)
+            yield line
+
+    material_ids, vectors, records = [], [], []
+    with gzip.open(snapshot_path, "rt", encoding="utf-8") as f, open(records_path, "wb") as out, Pool(processes) as pool:
+        results = pool.imap(_fingerprint_line, store(f, out), chunksize=64)
+        for i, result in enumerate(tqdm(results, desc = "Fingerprinting")):
+            if result is not None:
+                material_ids.append(result[0])
+                vectors.append(result[1])
+                records.append(i)
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    mean = vectors.mean(axis=0)
+    planes = np.random.default_rng(SEED).standard_normal((LSH_TABLES, FINGERPRINT_LENGTH, LSH_BITS)).astype(np.float32)
+    codes = _hash(vectors - mean, planes)
+    np.savez(
+        index_path,
+        material_ids=np.asarray(material_ids),
+        vectors=vectors,
+        mean=mean,
+        planes=planes,
+        codes=codes,
+        offsets=np.asarray(offsets, dtype=np.int64)[records],
+        lengths=np.asarray(lengths, dtype=np.int64)[records],
+    )
+    print(f"Indexed {len(material_ids)} structures to {index_path}")
+
+
+def _hash(centered: np.ndarray, planes: np.ndarray) -> np.ndarray:
+    """
+    LSH codes of shape (n, LSH_TABLES), one integer bucket id per table.
+    """
+    bits = np.einsum("nd,tdb->ntb", centered, planes) > 0
+    return (bits * (1 << np.arange(planes.shape[2]))).sum(axis=2).astype(np.int64)
+
+
+class StructureIndex:
+    def __init__(self, index_path: str = INDEX_PATH, records_path: str = RECORDS_PATH):
+        data = np.load(index_path)
+        self.material_ids = data["material_ids"]
+        self.position = {str(mid): i for i, mid in enumerate(self.material_ids)}
+        self.vectors = data["vectors"]
+        self.mean = data["mean"]
+        self.planes = data["planes"]
+        self.offsets = data["offsets"]
+        self.lengths = data["lengths"]
+        self.records_path = records_path
+        self.buckets = []
+        for codes in data["codes"].T:
+            order = np.argsort(codes, kind="stable")
+            keys, starts = np.unique(codes[order], return_index=True)
+            self.buckets.append(dict(zip(keys.tolist(), np.split(order, starts[1:]))))
+
+    def query(self, vector: np.ndarray, k: int = SHORTLIST) -> list[tuple[str, float]]:
+        """
+        Approximate k nearest fingerprints by cosine similarity, probing each table's bucket
+        and the buckets one bit away from it.
+        """
+        codes = _hash((vector - self.mean)[None, :], self.planes)[0]
+        found = []
+        for table, code in zip(self.buckets, codes):
+            for probe in [code, *(code ^ (1 << bit) for bit in range(LSH_BITS))]:
+                members = table.get(int(probe))
+                if members is not None:
+                    found.append(members)
+        if not found:
+            return []
+        candidates = np.unique(np.concatenate(found))
+        similarity = self.vectors[candidates] @ vector
+        top = np.argsort(-similarity)[:k]
+        return [(str(self.material_ids[candidates[i]]), float(similarity[i])) for i in top]
+
+    def vector(self, mp_id: str) -> np.ndarray:
+        return self.vectors[self.position[mp_id]]
+
+    def documents(self, material_ids) -> list:
+        """
+        Snapshot entries for `material_ids`, each read from the record store by its byte offset.
+        """
+        docs = []
+        with open(self.records_path, "rb") as f:
+            for mid in material_ids:
+                i = self.position[mid]
+                f.seek(int(self.offsets[i]))
+                docs.append(_document(json.loads(zlib.decompress(f.read(int(self.lengths[i]))))))
+        return docs
+
+
+def find_analogs(mp_id: str, k: int = SHORTLIST, index_path: str = INDEX_PATH, records_path: str = RECORDS_PATH):
+    """
+    Shortlist fingerprint neighbours of `mp_id` across all space groups, then confirm them
+    with StructureMatcher and write the usual analog dataset CSV.
+    """
+    from mp_structural_analogs import structure_comparisions_to_csv
+
+    index = StructureIndex(index_path, records_path)
+    if mp_id not in index.position:
+        raise KeyError(f"{mp_id} is not in {index_path}")
+    shortlist = index.query(index.vector(mp_id), k)
+    print(f"Shortlisted {len(shortlist)} of {len(index.material_ids)} indexed structures")
+    reference = index.documents([mp_id])[0]
+    candidates = index.documents([mid for mid, _ in shortlist])
+    structure_comparisions_to_csv(
+        mp_id,
+        "all",
+        reference.structure.composition.anonymized_formula,
+        reference.structure,
+        candidates,
+    )
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Structure fingerprint index for cross-space-group analog search")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("download", help="Download a structure snapshot from the Materials Project")
+    build = subparsers.add_parser("build", help="Fingerprint the snapshot and build the LSH index")
+    build.add_argument(
+        "--processes",
+        type = int,
+        help = "Worker processes for fingerprinting (default: all cores)"
+    )
+    query = subparsers.add_parser("query", help="Write an analog dataset for a material from the index")
+    query.add_argument(
+        "mp_id",
+        type = str,
+        help = "Reference material id, e.g. mp-30273"
+    )
+    query.add_argument(
+        "--shortlist",
+        type = int,
+        default = SHORTLIST,
+        help = "Number of nearest fingerprints to confirm with StructureMatcher"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = get_arguments()
+    if arguments.command == "download":
+        download_snapshot()
+    elif arguments.command == "build":
+        build_index(processes = arguments.processes)
+    elif arguments.command == "query":
+        find_analogs(arguments.mp_id, arguments.shortlist)